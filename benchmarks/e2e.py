@@ -0,0 +1,116 @@
+"""
+End to end poll benchmark: N simulated subscriptions over a set of tracking codes go through
+poll_tick -> ScrapeEngine -> check_update against the local courier stub, with a fake bot
+counting the messages that would be sent:
+
+    python -m benchmarks.e2e --subscriptions 2000 --codes 500
+    python -m benchmarks.e2e --database postgresql+pool://localhost:5432/courier_bench
+"""
+import argparse
+import json
+import os
+import tempfile
+import threading
+import time
+import uuid
+from typing import Any, Dict
+
+from benchmarks.stub import StubServer, install
+
+
+class FakeBot:
+    def __init__(self):
+        self.sent = 0
+        self.lock = threading.Lock()
+
+    def send_message(self, **kwargs):
+        with self.lock:
+            self.sent += 1
+
+
+class FakeContext:
+    def __init__(self, bot: FakeBot):
+        self.bot = bot
+
+
+def prepare(config: Dict[str, Any]):
+    """Import the bot with `config` and an empty database in a temporary directory, returns the main module"""
+    workdir = tempfile.mkdtemp(prefix='courier-bench-')
+    config = {"DATABASE": f"sqlite:///{os.path.join(workdir, 'database.db')}", **config}
+    config_path = os.path.join(workdir, 'config.json')
+    with open(config_path, 'w') as f:
+        json.dump(config, f)
+    os.environ['CHILE_COURIER_BOT_CONFIG'] = config_path
+
+    import main as bot
+    import migrations
+    migrations.run(bot.db)
+    return bot
+
+
+def populate(bot, subscriptions: int, codes: int, chats: int, delta: int = 60):
+    """Insert `subscriptions` jobs spread over `codes` tracking codes of every courier and `chats` chats"""
+    from models import JobModel, db
+    from sharding import key_hash
+
+    couriers = list(bot.dispatcher.keys())
+    with db.atomic():
+        for i in range(subscriptions):
+            code = i % codes
+            courier = couriers[code % len(couriers)]
+            JobModel.create(id=str(uuid.uuid4()), name=f"B{i:07d}", chat_id=str(i % chats), delta=str(delta),
+                            courier=courier, cod=f"BENCH{code}", desc=f"bench {i}",
+                            key_hash=key_hash((courier, f"BENCH{code}")))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--subscriptions', type=int, default=1000)
+    parser.add_argument('--codes', type=int, default=250, help='distinct tracking codes shared by the subscriptions')
+    parser.add_argument('--chats', type=int, default=100)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added by the stub to every response')
+    parser.add_argument('--timeout', type=float, default=300)
+    parser.add_argument('--database', help='URL of an empty database, a temporary sqlite one by default')
+    args = parser.parse_args()
+
+    bot = prepare({"BOT_KEY": "123456:bench", "DEV": False, **({"DATABASE": args.database} if args.database else {})})
+
+    stub = StubServer(latency=args.latency).start()
+    install(stub.url)
+
+    populate(bot, args.subscriptions, args.codes, args.chats)
+    from models import JobModel
+    bot.event_store.load()
+    for j in bot.registry.load(JobModel.select()):
+        bot.scheduler.subscribe((j.courier, j.cod), (j.chat_id, j.name), int(j.delta))
+
+    fake_bot = FakeBot()
+    bot.engine.start()
+    bot.outbox.start(lambda chat_id, text, parse_mode: fake_bot.send_message(chat_id=chat_id, text=text))
+    start = time.perf_counter()
+    bot.poll_tick(FakeContext(fake_bot))
+    while any(g.in_flight for g in list(bot.scheduler.groups.values())):
+        if time.perf_counter() - start > args.timeout:
+            raise TimeoutError("polls still in flight")
+        time.sleep(0.01)
+    elapsed = time.perf_counter() - start
+    queued = len(bot.outbox)
+    bot.outbox.stop(timeout=args.timeout)
+    send_elapsed = time.perf_counter() - start
+
+    flush_start = time.perf_counter()
+    written = bot.registry.flush()
+    flush_elapsed = time.perf_counter() - flush_start
+
+    bot.engine.stop()
+    stub.stop()
+
+    print(f"subscriptions:      {args.subscriptions} over {args.codes} codes")
+    print(f"courier requests:   {stub.requests}")
+    print(f"tick duration:      {elapsed:.2f}s ({args.subscriptions / elapsed:.0f} subscriptions/s)")
+    print(f"messages:           {queued} notifications sent as {fake_bot.sent} messages in {send_elapsed:.2f}s")
+    print(f"flush:              {written} rows in {flush_elapsed * 1000:.0f}ms")
+
+
+if __name__ == '__main__':
+    main()
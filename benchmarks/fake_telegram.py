@@ -0,0 +1,104 @@
+"""
+Minimal local stand-in for the Telegram Bot API: answers getMe/getUpdates and accepts
+sendMessage/sendPhoto, counting and timestamping every message the bot sends.
+"""
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional
+from urllib.parse import parse_qs
+
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "Simulated", "username": "simulated_courier_bot"}
+
+
+class FakeTelegram(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, port: int = 0, latency: float = 0.0, poll_wait: float = 0.5):
+        super().__init__(('127.0.0.1', port), FakeTelegramHandler)
+        self.latency = latency
+        self.poll_wait = poll_wait
+        self.sent: List[float] = []  # send time of every message
+        self.calls: Dict[str, int] = {}
+        self.message_id = 0
+        self.lock = threading.Lock()
+        self.thread: Optional[threading.Thread] = None
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}/bot"
+
+    def start(self) -> 'FakeTelegram':
+        self.thread = threading.Thread(target=self.serve_forever, name="fake-telegram", daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def message(self, params: Dict[str, Any], **extra) -> Dict[str, Any]:
+        with self.lock:
+            self.message_id += 1
+            self.sent.append(time.time())
+            message_id = self.message_id
+        chat_id = params.get("chat_id", 0)
+        return {"message_id": message_id, "date": int(time.time()), "from": BOT_USER,
+                "chat": {"id": int(chat_id) if str(chat_id).lstrip('-').isdigit() else 0, "type": "private"},
+                **extra}
+
+
+class FakeTelegramHandler(BaseHTTPRequestHandler):
+    server: FakeTelegram
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _params(self) -> Dict[str, Any]:
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+        content_type = self.headers.get('Content-Type', '')
+        if content_type.startswith('application/json') and body:
+            return json.loads(body)
+        if content_type.startswith('application/x-www-form-urlencoded'):
+            return {k: v[0] for k, v in parse_qs(body.decode()).items()}
+        if content_type.startswith('multipart/form-data'):
+            # uploads, only the chat_id matters here
+            marker = b'name="chat_id"\r\n\r\n'
+            start = body.find(marker)
+            if start >= 0:
+                start += len(marker)
+                return {"chat_id": body[start:body.find(b'\r\n', start)].decode()}
+        return {}
+
+    def do_POST(self):
+        params = self._params()
+        method = self.path.rsplit('/', 1)[-1]
+        with self.server.lock:
+            self.server.calls[method] = self.server.calls.get(method, 0) + 1
+
+        if method == 'getUpdates':
+            time.sleep(min(float(params.get('timeout', 0) or 0), self.server.poll_wait))
+            result: Any = []
+        elif method == 'getMe':
+            result = BOT_USER
+        elif method == 'sendMessage':
+            time.sleep(self.server.latency)
+            result = self.server.message(params, text=params.get("text", ""))
+        elif method == 'sendPhoto':
+            time.sleep(self.server.latency)
+            result = self.server.message(params, photo=[{"file_id": f"fake-{time.time_ns()}",
+                                                         "file_unique_id": "fake", "width": 1, "height": 1}])
+        else:
+            result = True
+
+        payload = json.dumps({"ok": True, "result": result}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    do_GET = do_POST
@@ -0,0 +1,82 @@
+"""
+Fetch+parse throughput and latency of every courier scrapper, replaying the recorded fixtures
+through the local stub server:
+
+    python -m benchmarks.scrapers --requests 500 --concurrency 16
+"""
+import argparse
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
+
+from tabulate import tabulate
+
+from benchmarks.stub import StubServer, install
+from couriers import DEFAULT_COURIERS, CourierRegistry
+
+COURIERS = CourierRegistry(DEFAULT_COURIERS)
+
+
+def percentile(values: List[float], p: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+def timed(fn) -> float:
+    start = time.perf_counter()
+    fn()
+    return time.perf_counter() - start
+
+
+def bench(name: str, calls: List, concurrency: int, codes_per_call: int = 1) -> List:
+    errors = 0
+    latencies = []
+
+    def run(call):
+        nonlocal errors
+        try:
+            latencies.append(timed(call))
+        except Exception:
+            errors += 1
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(run, calls))
+    elapsed = time.perf_counter() - start
+
+    ms = [l * 1000 for l in latencies] or [0.0]
+    return [name, len(calls), errors, len(calls) * codes_per_call / elapsed,
+            statistics.mean(ms), percentile(ms, 50), percentile(ms, 95), max(ms)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=200, help='scrapes per courier')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--batch', type=int, default=25, help='codes per call for couriers with batch lookups')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added by the stub to every response')
+    args = parser.parse_args()
+
+    stub = StubServer(latency=args.latency).start()
+    install(stub.url, pool_maxsize=args.concurrency)
+
+    rows = []
+    for name, scrapper_cls in COURIERS.items():
+        scrapper_cls(f"{name}0").get_data()  # warm up sessions outside the measure
+        calls = [scrapper_cls(f"{name}{i}").get_data for i in range(args.requests)]
+        rows.append(bench(name, calls, args.concurrency))
+        if scrapper_cls.max_batch > 1:
+            batch = min(args.batch, scrapper_cls.max_batch)
+            calls = [lambda i=i: scrapper_cls.get_events_many([f"{name}{i}-{j}" for j in range(batch)])
+                     for i in range(max(1, args.requests // batch))]
+            rows.append(bench(f"{name} (batch {batch})", calls, args.concurrency, codes_per_call=batch))
+
+    stub.stop()
+    print(tabulate(rows, headers=['courier', 'calls', 'errors', 'codes/s', 'mean ms', 'p50 ms', 'p95 ms', 'max ms'],
+                   floatfmt='.1f'))
+    print(f"stub served {stub.requests} requests")
+
+
+if __name__ == '__main__':
+    main()
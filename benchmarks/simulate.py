@@ -0,0 +1,100 @@
+"""
+Load simulation: runs the whole bot (updater, job queue, scheduler, scrape engine) against a fake
+Telegram Bot API and the courier stub with configurable latency and error rates, then reports
+job lag, missed ticks, message throughput and memory:
+
+    python -m benchmarks.simulate --subscriptions 10000 --codes 2500 --duration 300 --courier-latency 0.3
+"""
+import argparse
+import statistics
+import threading
+import time
+from collections import Counter
+from typing import List
+
+import psutil
+
+from benchmarks.e2e import prepare, populate
+from benchmarks.fake_telegram import FakeTelegram
+from benchmarks.scrapers import percentile
+from benchmarks.stub import StubServer, install
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--subscriptions', type=int, default=10000)
+    parser.add_argument('--codes', type=int, default=2500, help='distinct tracking codes shared by the subscriptions')
+    parser.add_argument('--chats', type=int, default=500)
+    parser.add_argument('--delta', type=int, default=60, help='poll interval of every subscription, seconds')
+    parser.add_argument('--duration', type=float, default=180, help='seconds to run the bot')
+    parser.add_argument('--courier-latency', type=float, default=0.2)
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of courier requests answering 503')
+    parser.add_argument('--telegram-latency', type=float, default=0.0)
+    parser.add_argument('--adaptive', action='store_true', help='enable ADAPTIVE_POLLING')
+    args = parser.parse_args()
+
+    stub = StubServer(latency=args.courier_latency, error_rate=args.error_rate).start()
+    telegram = FakeTelegram(latency=args.telegram_latency).start()
+
+    bot = prepare({"BOT_KEY": "123456:simulation", "DEV": False, "BOT_API_URL": telegram.base_url,
+                   "ADAPTIVE_POLLING": args.adaptive})
+    install(stub.url)
+    populate(bot, args.subscriptions, args.codes, args.chats, args.delta)
+
+    lags: List[float] = []
+    missed_polls = 0
+
+    def on_dispatch(key, lag):
+        nonlocal missed_polls
+        lags.append(lag)
+        group = bot.scheduler.groups.get(key)
+        if group is not None:
+            missed_polls += int(lag // group.interval)
+
+    bot.scheduler.on_dispatch = on_dispatch
+
+    ticks: List[float] = []
+    poll_tick = bot.poll_tick
+
+    def timed_tick(context):
+        ticks.append(time.time())
+        poll_tick(context)
+
+    bot.poll_tick = timed_tick
+
+    process = psutil.Process()
+    rss_start = process.memory_info().rss
+    start = time.time()
+    updater = bot.create_updater()
+    startup = time.time() - start
+    updater.start_polling(timeout=1)
+
+    rss_peak = rss_start
+    stop = threading.Event()
+    while not stop.wait(1.0) and time.time() - start < args.duration:
+        rss_peak = max(rss_peak, process.memory_info().rss)
+
+    updater.stop()
+    bot.shutdown()
+    stub.stop()
+    telegram.stop()
+    elapsed = time.time() - start
+
+    per_second = Counter(int(t) for t in telegram.sent)
+    expected_ticks = int(elapsed // bot.POLL_TICK)
+    lag_ms = [lag * 1000 for lag in lags] or [0.0]
+
+    print(f"subscriptions:        {args.subscriptions} over {args.codes} codes, {args.chats} chats")
+    print(f"run time:             {elapsed:.0f}s (startup {startup:.2f}s)")
+    print(f"poll ticks:           {len(ticks)} run, {max(0, expected_ticks - len(ticks))} missed")
+    print(f"polls dispatched:     {len(lags)}, {missed_polls} missed intervals")
+    print(f"job lag:              mean {statistics.mean(lag_ms):.0f}ms p95 {percentile(lag_ms, 95):.0f}ms "
+          f"max {max(lag_ms):.0f}ms")
+    print(f"courier requests:     {stub.requests}")
+    print(f"messages:             {len(telegram.sent)} ({len(telegram.sent) / elapsed:.1f}/s avg, "
+          f"{max(per_second.values(), default=0)}/s peak)")
+    print(f"rss:                  {rss_start / 2 ** 20:.0f}MiB start, {rss_peak / 2 ** 20:.0f}MiB peak")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,144 @@
+"""
+Local stand-in for the courier sites: replays the recorded responses in benchmarks/fixtures
+and a requests adapter that redirects every courier url to it.
+"""
+import hashlib
+import json
+import pathlib
+import random as rnd
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional, Tuple
+from urllib.parse import urlsplit, urlunsplit
+
+from requests.adapters import HTTPAdapter
+
+FIXTURES = pathlib.Path(__file__).parent.joinpath('fixtures')
+
+
+def load_routes() -> List[Dict[str, Any]]:
+    routes = []
+    for fixture in sorted(FIXTURES.glob('*.json')):
+        with open(fixture, 'r') as f:
+            routes.extend(json.load(f)["routes"])
+    return routes
+
+
+class StubServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # the default backlog of 5 drops connects of a burst of scrapes, which then wait a whole SYN retry
+    request_queue_size = 128
+
+    def __init__(self, port: int = 0, latency: float = 0.0, error_rate: float = 0.0):
+        super().__init__(('127.0.0.1', port), StubHandler)
+        self.routes = load_routes()
+        self.latency = latency
+        self.error_rate = error_rate
+        self.requests = 0
+        self.lock = threading.Lock()
+        self.thread: Optional[threading.Thread] = None
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def start(self) -> 'StubServer':
+        self.thread = threading.Thread(target=self.serve_forever, name="courier-stub", daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def route(self, method: str, host: str, path: str) -> Optional[Dict[str, Any]]:
+        candidates = [r for r in self.routes if r["method"] == method and r["host"] == host
+                      and path.startswith(r["path"])]
+        return max(candidates, key=lambda r: len(r["path"]), default=None)
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    server: StubServer
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, status: int, headers: Dict[str, str], body: str):
+        payload = body.encode()
+        self.send_response(status)
+        for k, v in headers.items():
+            self.send_header(k, v)
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def _handle(self, method: str):
+        with self.server.lock:
+            self.server.requests += 1
+        length = int(self.headers.get('Content-Length') or 0)
+        request_body = self.rfile.read(length) if length else b''
+
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        if self.server.error_rate and rnd.random() < self.server.error_rate:
+            self._reply(503, {'Content-Type': 'text/html'}, '<html>Service Unavailable</html>')
+            return
+
+        _, host, path = self.path.split('/', 2)
+        route = self.server.route(method, host, '/' + path.split('?', 1)[0])
+        if route is None:
+            self._reply(404, {'Content-Type': 'text/html'}, '<html>Not Found</html>')
+            return
+
+        body = route["body"]
+        if "batch" in route and request_body:
+            body = batch_body(route, request_body)
+        headers = route["headers"]
+        if route.get("etag"):
+            etag = '"%s"' % hashlib.md5(body.encode()).hexdigest()
+            if self.headers.get('If-None-Match') == etag:
+                self._reply(304, {'ETag': etag}, '')
+                return
+            headers = {**headers, 'ETag': etag}
+        self._reply(route["status"], headers, body)
+
+    def do_GET(self):
+        self._handle('GET')
+
+    def do_POST(self):
+        self._handle('POST')
+
+
+def batch_body(route: Dict[str, Any], request_body: bytes) -> str:
+    """Repeat the recorded item once per requested code for endpoints answering several codes at once"""
+    batch = route["batch"]
+    codes = json.loads(request_body)[batch["request_key"]]
+    recorded = json.loads(route["body"])
+    item = recorded[batch["response_key"]][-1]
+    recorded[batch["response_key"]] = [{**item, batch["code_key"]: code} for code in codes]
+    return json.dumps(recorded)
+
+
+class RedirectAdapter(HTTPAdapter):
+    """Send https://host/path to {stub}/host/path so the scrappers run unmodified against the stub"""
+
+    def __init__(self, stub_url: str, **kwargs):
+        self.stub = urlsplit(stub_url)
+        super().__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        url = urlsplit(request.url)
+        request.url = urlunsplit((self.stub.scheme, self.stub.netloc, f"/{url.netloc}{url.path}", url.query, ''))
+        return super().send(request, **kwargs)
+
+
+def install(stub_url: str, pool_maxsize: int = 32) -> Tuple[Any, Any]:
+    """Point the shared courier session pool at the stub, returns (old pool, new pool)"""
+    import classes
+
+    old = classes.sessions
+    classes.sessions = classes.SessionPool(pool_maxsize,
+                                           adapter=lambda maxsize: RedirectAdapter(stub_url, pool_maxsize=maxsize))
+    return old, classes.sessions
@@ -0,0 +1,104 @@
+import threading
+import time
+from typing import Dict, List, Mapping, Optional, Tuple
+
+from classes import Event, dump_events, load_events
+from models import ScrapeResultModel, db
+from scheduler import PollKey
+
+CachedResult = Tuple[List[Event], float]  # (events, fetched_at)
+
+
+class ResultCache:
+    """
+    Last successful scrape of every (courier, cod), fresh for `ttls[courier]` (or `default_ttl`) seconds.
+    Polls and /force_get reuse a fresh result instead of scraping again. Results are written behind
+    by `flush` so a restart starts with what was fetched before it, unless `read_through`, where every
+    call goes to the database (the front process of a sharded deployment).
+    """
+
+    def __init__(self, ttls: Optional[Mapping[str, float]] = None, default_ttl: float = 30,
+                 read_through: bool = False):
+        self.ttls = ttls or {}
+        self.default_ttl = default_ttl
+        self.read_through = read_through
+        self.results: Dict[PollKey, CachedResult] = {}
+        self.pending: Dict[PollKey, CachedResult] = {}
+        self.lock = threading.Lock()
+
+    def ttl(self, courier: str) -> float:
+        return self.ttls.get(courier, self.default_ttl)
+
+    @property
+    def max_ttl(self) -> float:
+        return max([self.default_ttl, *self.ttls.values()])
+
+    def load(self) -> int:
+        """Load the results still fresh for some courier, returns how many"""
+        rows = ScrapeResultModel.select().where(ScrapeResultModel.fetched_at > time.time() - self.max_ttl)
+        with self.lock:
+            for row in rows:
+                try:
+                    self.results[(row.courier, row.cod)] = (load_events(row.data), row.fetched_at)
+                except (ValueError, TypeError):
+                    # saved before results were event lists
+                    continue
+            return len(self.results)
+
+    def peek(self, key: PollKey) -> Optional[CachedResult]:
+        """Last result regardless of its age"""
+        if self.read_through:
+            row = ScrapeResultModel.get_or_none(ScrapeResultModel.courier == key[0], ScrapeResultModel.cod == key[1])
+            if row is None:
+                return None
+            try:
+                return load_events(row.data), row.fetched_at
+            except (ValueError, TypeError):
+                return None
+        with self.lock:
+            return self.results.get(key)
+
+    def get(self, key: PollKey) -> Optional[List[Event]]:
+        """Last result if it is still fresh"""
+        cached = self.peek(key)
+        if cached is None or time.time() - cached[1] >= self.ttl(key[0]):
+            return None
+        return cached[0]
+
+    def set(self, key: PollKey, events: List[Event]):
+        cached = (events, time.time())
+        if self.read_through:
+            self._write({key: cached})
+            return
+        with self.lock:
+            previous = self.results.get(key)
+            self.results[key] = cached
+            # the same events object means an unchanged response, only its freshness is renewed
+            if previous is None or previous[0] is not events:
+                self.pending[key] = cached
+
+    def flush(self) -> int:
+        """Write the pending results in one transaction and forget the expired ones"""
+        with self.lock:
+            pending, self.pending = self.pending, {}
+            oldest = time.time() - self.max_ttl
+            self.results = {key: cached for key, cached in self.results.items() if cached[1] > oldest}
+        if len(pending) == 0:
+            return 0
+        try:
+            self._write(pending)
+        except Exception:
+            with self.lock:
+                self.pending = {**pending, **self.pending}
+            raise
+        return len(pending)
+
+    @staticmethod
+    def _write(results: Mapping[PollKey, CachedResult]):
+        with db.atomic():
+            for (courier, cod), (events, fetched_at) in results.items():
+                data = dump_events(events)
+                (ScrapeResultModel.insert(courier=courier, cod=cod, data=data, fetched_at=fetched_at)
+                 .on_conflict(conflict_target=[ScrapeResultModel.courier, ScrapeResultModel.cod],
+                              update={ScrapeResultModel.data: data, ScrapeResultModel.fetched_at: fetched_at})
+                 .execute())
@@ -1,158 +1,271 @@
+import asyncio
+import hashlib
 import json
-import random as rnd
-import signal
-import sys
-from dataclasses import dataclass
-from datetime import datetime
-from typing import Union, List, Mapping
-
-import bs4
+import re
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Executor, ThreadPoolExecutor
+from dataclasses import asdict, dataclass
+from typing import Union, List, Mapping, Optional, ClassVar, Dict, Callable, Tuple, Type, TypeVar
+
 import requests
-from coolname import generate_slug
+from requests.adapters import HTTPAdapter
 
+JSON_Type = Union[str, int, float, bool, None, Mapping[str, 'JSON_Type'], List['JSON_Type']]
 
-# noinspection PyShadowingNames,PyUnusedLocal
-from requests.structures import CaseInsensitiveDict
 
+@dataclass(frozen=True)
+class Event:
+    """One step of a shipment tracking history"""
+    timestamp: str  # ISO 8601, empty when the courier does not give one
+    status: str
+    location: str = ''
 
-def signal_handler(signal, frame):
-    print("\nprogram exiting gracefully")
-    sys.exit(0)
+    def __str__(self):
+        return ' '.join(part for part in (self.timestamp[:16].replace('T', ' '), self.location, self.status) if part)
 
 
-signal.signal(signal.SIGINT, signal_handler)
+def dump_events(events: List[Event]) -> str:
+    return json.dumps([asdict(e) for e in events])
 
-JSON_Type = Union[str, int, float, bool, None, Mapping[str, 'JSON_Type'], List['JSON_Type']]
 
+def load_events(text: str) -> List[Event]:
+    return [Event(**e) for e in json.loads(text)]
 
-@dataclass
-class RawDataScrapper:
-    cod: str
 
-    def get_data(self) -> str:
-        raise NotImplementedError()
+# the tracking history, oldest event first
+ScrapeResult = Union[List[Event], Exception]
 
+# status codes meaning the warm-up cookies/tokens are no longer accepted
+REJECTED_STATUS = (401, 403, 419)
 
-@dataclass
-class DevDataScrapper(RawDataScrapper):
-    last: str = generate_slug(4)
+IDLE, DELIVERING, TERMINAL = "idle", "delivering", "terminal"
 
-    def get_data(self) -> str:
-        length = rnd.randint(4, 8)
-        self.last = rnd.choice([self.last, generate_slug(length)])
-        return self.last
 
+def status_pattern(*statuses: str) -> re.Pattern:
+    """
+    Matches a scraped status (the end of an event text) that is one of the whole `statuses`, so
+    "Envío no pudo ser entregado" or "Pendiente de ser entregado" do not pass as "Entregado".
+    """
+    return re.compile(r'(?<!\bno )(?<!\bser )(?<!\bpendiente )(?<!\bintento )(?<!\bsin )'
+                      r'\b(' + '|'.join(re.escape(status) for status in statuses) + r')\s*$', re.IGNORECASE)
 
-class BluexRaw(RawDataScrapper):
-    cod: str
 
-    def get_data(self) -> str:
-        url = "https://www.blue.cl/wp-admin/admin-ajax.php"
-
-        headers = CaseInsensitiveDict()
-        headers["User-Agent"] = "Mozilla/5.0 (Macintosh; Intel Mac OS X 10.15; rv:95.0) Gecko/20100101 Firefox/95.0"
-        headers["Accept"] = "application/json, text/javascript, */*; q=0.01"
-        headers["Accept-Language"] = "es-CL,es;q=0.8,en-US;q=0.5,en;q=0.3"
-        headers["Accept-Encoding"] = "gzip, deflate, br"
-        headers["Content-Type"] = "application/x-www-form-urlencoded; charset=UTF-8"
-        headers["X-Requested-With"] = "XMLHttpRequest"
-        headers["Origin"] = "https://www.blue.cl"
-        headers["DNT"] = "1"
-        headers["Connection"] = "keep-alive"
-        headers["Referer"] = f"https://www.blue.cl/seguimiento/?n_seguimiento={self.cod}"
-        headers["Sec-Fetch-Dest"] = "empty"
-        headers["Sec-Fetch-Mode"] = "cors"
-        headers["Sec-Fetch-Site"] = "same-origin"
-        headers["Sec-GPC"] = "1"
-        headers["Pragma"] = "no-cache"
-        headers["Cache-Control"] = "no-cache"
-        headers["TE"] = "trailers"
-
-        data = f"action=getTrackingInfo&n_seguimiento={self.cod}"
-
-        response = requests.post(url, headers=headers, data=data)
-        response_data = response.json()["data"]
-        data_raw = json.loads(response_data[0])
-
-        last_data = data_raw['s1']['listaDocumentos'][0]['ultimoPinchazo']
-        date = datetime.strptime(last_data["fecha"], '%Y%m%d%H%M%S').isoformat()
-
-        return f"{date} {last_data['nombreTipo']}"
-
-
-class PullmanBusCargoRaw(RawDataScrapper):
-    cod: str
+class SessionPool:
+    """
+    One keep-alive session per courier, shared by every scrapper instance, plus the time its warm-up
+    cookies/tokens were fetched so the warm-up page is only requested again after `ttl` or a rejection.
+    """
 
-    def get_data(self) -> str:
-        res = requests.post(
-            f'http://www.pullmancargo.cl/WEB/cuentacorrientecarga/funciones/ajax2.php?op=consultaodt&odt={self.cod}')
-        last = res.json()[0]
-        return f"{last['FECHA']} {last['AGENCIA']} {last['estadoweb']}"
+    def __init__(self, pool_maxsize: int = 32, adapter: Optional[Callable[[int], HTTPAdapter]] = None):
+        self.pool_maxsize = pool_maxsize
+        self.adapter = adapter or (lambda maxsize: HTTPAdapter(pool_maxsize=maxsize))
+        self.sessions: Dict[str, requests.Session] = {}
+        self.warmed_at: Dict[str, float] = {}
+        self.locks: Dict[str, threading.Lock] = {}
+        self.lock = threading.Lock()
 
+    def _new_session(self, headers: Mapping[str, str]) -> requests.Session:
+        s = requests.Session()
+        adapter = self.adapter(self.pool_maxsize)
+        s.mount('https://', adapter)
+        s.mount('http://', adapter)
+        s.headers.update(headers)
+        return s
+
+    def get(self, courier: str, headers: Mapping[str, str], warm_up: Callable[[requests.Session], None],
+            ttl: float) -> requests.Session:
+        with self.lock:
+            if courier not in self.sessions:
+                self.sessions[courier] = self._new_session(headers)
+                self.locks[courier] = threading.Lock()
+            s = self.sessions[courier]
+            courier_lock = self.locks[courier]
+
+        with courier_lock:
+            if time.time() - self.warmed_at.get(courier, 0) > ttl:
+                warm_up(s)
+                self.warmed_at[courier] = time.time()
+        return s
+
+    def invalidate(self, courier: str):
+        with self.lock:
+            s = self.sessions.get(courier)
+            self.warmed_at.pop(courier, None)
+        if s is not None:
+            s.cookies.clear()
+
+
+sessions = SessionPool()
 
-class StarkenRaw(RawDataScrapper):
-    cod: str
 
-    def get_data(self) -> str:
-        s = requests.Session()
-        s.headers.update(
-            {'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:78.0) Gecko/20100101 Firefox/78.0'})
-        s.get("https://www.starken.cl/seguimiento")
-        res = s.get(f"https://gateway.starken.cl/tracking/orden-flete-dte/of/{self.cod}")
-        data = res.json()
-        updated_at = datetime.strptime(data["updated_at"], '%Y-%m-%dT%H:%M:%S.%fZ')
+@dataclass
+class CachedResponse:
+    etag: Optional[str]
+    last_modified: Optional[str]
+    digest: str
+    events: List[Event]
+
+
+class ResponseCache:
+    """
+    Validators, body hash and parsed events of the last response of every (courier, cod), LRU bounded.
+    A poll answered with 304, or with the same body as before, reuses the events of the previous one
+    (the same list object, which tells the callers nothing changed) instead of parsing again.
+    """
+
+    def __init__(self, max_entries: int = 100_000):
+        self.max_entries = max_entries
+        self.entries: 'OrderedDict[Tuple[str, str], CachedResponse]' = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key: Tuple[str, str]) -> Optional[CachedResponse]:
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+            return entry
+
+    def set(self, key: Tuple[str, str], entry: CachedResponse):
+        with self.lock:
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+
+responses = ResponseCache()
 
-        return f"{data['status']} {updated_at.strftime('%Y-%m-%d %H:%M')}"
+S = TypeVar('S', bound='RawDataScrapper')
 
 
-class ChileExpressRaw(RawDataScrapper):
+@dataclass
+class RawDataScrapper:
     cod: str
 
+    session_headers: ClassVar[Dict[str, str]] = {}
+    warm_up_ttl: ClassVar[float] = 30 * 60
+    timeout: ClassVar[float] = 30
+    # couriers whose endpoint accepts several codes per request override `fetch_many` and set `max_batch` > 1
+    max_batch: ClassVar[int] = 1
+    # matched against the scraped status to adapt the polling interval, couriers list their own final statuses
+    terminal_pattern: ClassVar[re.Pattern] = status_pattern('entregado', 'entregada', 'delivered',
+                                                            'devuelto al remitente', 'devuelta al remitente')
+    delivering_pattern: ClassVar[re.Pattern] = re.compile(r'\b(en reparto|en ruta|out for delivery|en camino)\b',
+                                                          re.IGNORECASE)
+    # format of the tracking codes of the courier, None when anything may be one
+    code_pattern: ClassVar[Optional[re.Pattern]] = None
+    # defaults for couriers without RATE_LIMITS / COURIER_CONCURRENCY config: {"rate": per second, "burst": n}
+    # and how many requests may be in flight at once
+    rate_limit: ClassVar[Optional[Mapping[str, float]]] = None
+    concurrency: ClassVar[Optional[int]] = None
+
+    @classmethod
+    def matches(cls, code: str) -> bool:
+        """Whether `code` may be a tracking code of this courier"""
+        return cls.code_pattern is None or cls.code_pattern.fullmatch(code) is not None
+
+    def get_events(self) -> List[Event]:
+        raise NotImplementedError()
+
     def get_data(self) -> str:
-        s = requests.Session()
-        s.headers.update(
-            {'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:78.0) Gecko/20100101 Firefox/78.0',
-             'Ocp-Apim-Subscription-Key': "7b878d2423f349e3b8bbb9b3607d4215"
-             })
-        s.get(f"https://centrodeayuda.chilexpress.cl/seguimiento/{self.cod}")
-        res = s.get(
-            f"https://services.wschilexpress.com/agendadigital/api/v3/Tracking/GetTracking?gls_Consulta={self.cod}")
-        data = res.json()
-        last = data['ListTracking'][0]
-        try:
-            updated_at = datetime.fromisoformat(last["fec_track"])
-        except ValueError:
-            updated_at = datetime.strptime(last["fec_track"], '%Y-%m-%dT%H:%M:%S.%f')
-
-        return f"{last['gls_tracking']} {updated_at.strftime('%Y-%m-%d %H:%M')}"
-
-
-class UPSRaw(RawDataScrapper):
-    def get_data(self) -> str:
-        import requests
+        """The latest event as text"""
+        return self.summarize(self.get_events())
+
+    @classmethod
+    def summarize(cls, events: List[Event]) -> str:
+        if len(events) == 0:
+            raise LookupError("No tracking events")
+        return str(events[-1])
+
+    @classmethod
+    def classify(cls, data: Optional[str]) -> str:
+        """Shipment state of a scraped status: TERMINAL, DELIVERING or IDLE"""
+        if data is None or data == "ERROR":
+            return IDLE
+        if cls.terminal_pattern.search(data):
+            return TERMINAL
+        if cls.delivering_pattern.search(data):
+            return DELIVERING
+        return IDLE
+
+    @classmethod
+    def fetch_many(cls: Type[S], codes: List[str]) -> Dict[str, ScrapeResult]:
+        """Native multi-code lookup of at most `max_batch` codes"""
+        raise NotImplementedError()
 
-        s = requests.Session()
-        s.get("https://www.ups.com/track?loc=es_CL&requester=ST/")
-
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10.15; rv:92.0) Gecko/20100101 Firefox/92.0',
-            'Accept': 'application/json, text/plain, */*',
-            'Accept-Language': 'es-CL,es;q=0.8,en-US;q=0.5,en;q=0.3',
-            'Referer': 'https://www.ups.com/track?loc=es_CL&requester=ST/',
-            'X-XSRF-TOKEN': s.cookies.get("X-XSRF-TOKEN-ST"),
-            'Origin': 'https://www.ups.com',
-            'DNT': '1',
-            'Connection': 'keep-alive',
-            'Sec-Fetch-Dest': 'empty',
-            'Sec-Fetch-Mode': 'cors',
-            'Sec-Fetch-Site': 'same-origin',
-            'Sec-GPC': '1',
-            'Pragma': 'no-cache',
-            'Cache-Control': 'no-cache',
-        }
-
-        data = {"Locale": "es_CL", "TrackingNumber": [self.cod]}
-
-        response = s.post('https://www.ups.com/track/api/Track/GetStatus?loc=es_CL', headers=headers, json=data)
-        result = response.json()
-        return result['trackDetails'][-1]['packageStatus']
+    @classmethod
+    def get_events_many(cls: Type[S], codes: List[str]) -> Dict[str, ScrapeResult]:
+        """Look up several codes, in native batches if supported or else with concurrent single fetches"""
+        if cls.max_batch > 1:
+            results = {}
+            for i in range(0, len(codes), cls.max_batch):
+                chunk = codes[i:i + cls.max_batch]
+                try:
+                    results.update(cls.fetch_many(chunk))
+                except Exception as e:
+                    results.update({code: e for code in chunk})
+            return results
+
+        def get_one(code: str) -> ScrapeResult:
+            try:
+                return cls(code).get_events()
+            except Exception as e:
+                return e
+
+        with ThreadPoolExecutor(max_workers=max(1, min(len(codes), 8))) as executor:
+            return dict(zip(codes, executor.map(get_one, codes)))
+
+    def warm_up(self, s: requests.Session):
+        """Request whatever page sets the cookies/tokens the courier api needs, nothing by default"""
+
+    def request_headers(self, s: requests.Session) -> Mapping[str, str]:
+        return {}
+
+    def session(self) -> requests.Session:
+        return sessions.get(type(self).__name__, self.session_headers, self.warm_up, self.warm_up_ttl)
+
+    def request(self, method: str, url: str, headers: Optional[Mapping[str, str]] = None,
+                **kwargs) -> requests.Response:
+        """Request through the pooled courier session, warming it up again once if the tokens are rejected"""
+        s = self.session()
+        res = s.request(method, url, headers={**self.request_headers(s), **(headers or {})}, timeout=self.timeout,
+                        **kwargs)
+        if res.status_code in REJECTED_STATUS:
+            sessions.invalidate(type(self).__name__)
+            s = self.session()
+            res = s.request(method, url, headers={**self.request_headers(s), **(headers or {})},
+                            timeout=self.timeout, **kwargs)
+        return res
+
+    def request_events(self, method: str, url: str, parse: Callable[[requests.Response], List[Event]],
+                       **kwargs) -> List[Event]:
+        """
+        Request the tracking of this code and `parse` it, unless the courier answers 304 to the validators
+        of the previous response or sends the same body again, then the previous events are returned.
+        """
+        key = (type(self).__name__, self.cod)
+        previous = responses.get(key)
+        headers = {}
+        if previous is not None and previous.etag:
+            headers['If-None-Match'] = previous.etag
+        if previous is not None and previous.last_modified:
+            headers['If-Modified-Since'] = previous.last_modified
+        res = self.request(method, url, headers=headers, **kwargs)
+        if res.status_code == 304 and previous is not None:
+            return previous.events
+
+        digest = hashlib.blake2b(res.content, digest_size=16).hexdigest()
+        if previous is not None and previous.digest == digest:
+            return previous.events
+        events = parse(res)
+        if res.status_code == 200:
+            responses.set(key, CachedResponse(res.headers.get('ETag'), res.headers.get('Last-Modified'), digest,
+                                              events))
+        return events
+
+    async def get_events_async(self, executor: Optional[Executor] = None) -> List[Event]:
+        """Async counterpart of get_events, by default runs the blocking scrapper in `executor`"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(executor, self.get_events)
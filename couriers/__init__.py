@@ -0,0 +1,60 @@
+"""
+Courier plugins. Every courier is a RawDataScrapper subclass in its own module, registered by name
+with a "module:Class" spec and imported the first time it is used.
+"""
+import importlib
+import threading
+from collections.abc import Mapping
+from typing import Dict, Iterator, Optional, Type
+
+from classes import RawDataScrapper
+
+DEFAULT_COURIERS = {
+    'Chilexpress': 'couriers.chilexpress:ChileExpressRaw',
+    'Bluex': 'couriers.bluex:BluexRaw',
+    'PullmanBusCargo': 'couriers.pullman:PullmanBusCargoRaw',
+    'Starken': 'couriers.starken:StarkenRaw',
+    'UPS': 'couriers.ups:UPSRaw',
+}
+DEV_COURIERS = {
+    'develop': 'couriers.develop:DevDataScrapper',
+}
+
+
+def load(spec: str) -> Type[RawDataScrapper]:
+    module, name = spec.split(':', 1)
+    scrapper = getattr(importlib.import_module(module), name)
+    if not (isinstance(scrapper, type) and issubclass(scrapper, RawDataScrapper)):
+        raise TypeError(f"{spec} is not a RawDataScrapper")
+    return scrapper
+
+
+class CourierRegistry(Mapping):
+    """
+    Read-only mapping of courier name to scrapper class. Names and their order are known without
+    importing anything, a courier module is imported when its class is first looked up.
+    A spec of None removes a default courier.
+    """
+
+    def __init__(self, specs: Mapping[str, Optional[str]]):
+        self.specs: Dict[str, str] = {name: spec for name, spec in specs.items() if spec}
+        self.loaded: Dict[str, Type[RawDataScrapper]] = {}
+        self.lock = threading.Lock()
+
+    def __getitem__(self, name: str) -> Type[RawDataScrapper]:
+        scrapper = self.loaded.get(name)
+        if scrapper is None:
+            spec = self.specs[name]
+            with self.lock:
+                scrapper = self.loaded.get(name) or load(spec)
+                self.loaded[name] = scrapper
+        return scrapper
+
+    def __contains__(self, name) -> bool:
+        return name in self.specs
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.specs)
+
+    def __len__(self) -> int:
+        return len(self.specs)
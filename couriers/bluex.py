@@ -0,0 +1,56 @@
+import json
+import re
+from datetime import datetime
+from typing import List, Mapping
+
+import requests
+from requests.structures import CaseInsensitiveDict
+
+from classes import Event, RawDataScrapper, status_pattern
+
+
+class BluexRaw(RawDataScrapper):
+    cod: str
+
+    code_pattern = re.compile(r'\d{8,12}')
+    terminal_pattern = status_pattern('entregado', 'entrega exitosa', 'devuelto al remitente')
+
+    session_headers = {
+        "User-Agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10.15; rv:95.0) Gecko/20100101 Firefox/95.0",
+        "Accept": "application/json, text/javascript, */*; q=0.01",
+        "Accept-Language": "es-CL,es;q=0.8,en-US;q=0.5,en;q=0.3",
+        "Accept-Encoding": "gzip, deflate, br",
+        "Content-Type": "application/x-www-form-urlencoded; charset=UTF-8",
+        "X-Requested-With": "XMLHttpRequest",
+        "Origin": "https://www.blue.cl",
+        "DNT": "1",
+        "Connection": "keep-alive",
+        "Sec-Fetch-Dest": "empty",
+        "Sec-Fetch-Mode": "cors",
+        "Sec-Fetch-Site": "same-origin",
+        "Sec-GPC": "1",
+        "Pragma": "no-cache",
+        "Cache-Control": "no-cache",
+        "TE": "trailers",
+    }
+
+    def request_headers(self, s: requests.Session) -> Mapping[str, str]:
+        headers = CaseInsensitiveDict()
+        headers["Referer"] = f"https://www.blue.cl/seguimiento/?n_seguimiento={self.cod}"
+        return headers
+
+    def get_events(self) -> List[Event]:
+        url = "https://www.blue.cl/wp-admin/admin-ajax.php"
+        data = f"action=getTrackingInfo&n_seguimiento={self.cod}"
+        return self.request_events("POST", url, self.parse, data=data)
+
+    @staticmethod
+    def parse(response: requests.Response) -> List[Event]:
+        response_data = response.json()["data"]
+        data_raw = json.loads(response_data[0])
+
+        # the tracking page only gives the last scan
+        last_data = data_raw['s1']['listaDocumentos'][0]['ultimoPinchazo']
+        date = datetime.strptime(last_data["fecha"], '%Y%m%d%H%M%S').isoformat()
+
+        return [Event(date, last_data['nombreTipo'])]
@@ -0,0 +1,40 @@
+import re
+from datetime import datetime
+from typing import List
+
+import requests
+
+from classes import Event, RawDataScrapper, status_pattern
+
+
+class ChileExpressRaw(RawDataScrapper):
+    cod: str
+
+    code_pattern = re.compile(r'\d{10,12}')
+    terminal_pattern = status_pattern('entregado', 'envío entregado', 'pieza entregada', 'devuelto a remitente',
+                                      'devuelto al remitente')
+
+    session_headers = {'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:78.0) Gecko/20100101 Firefox/78.0',
+                       'Ocp-Apim-Subscription-Key': "7b878d2423f349e3b8bbb9b3607d4215"}
+
+    def warm_up(self, s: requests.Session):
+        s.get(f"https://centrodeayuda.chilexpress.cl/seguimiento/{self.cod}", timeout=self.timeout)
+
+    @staticmethod
+    def parse_date(text: str) -> datetime:
+        try:
+            return datetime.fromisoformat(text)
+        except ValueError:
+            return datetime.strptime(text, '%Y-%m-%dT%H:%M:%S.%f')
+
+    def get_events(self) -> List[Event]:
+        return self.request_events(
+            "GET",
+            f"https://services.wschilexpress.com/agendadigital/api/v3/Tracking/GetTracking?gls_Consulta={self.cod}",
+            self.parse)
+
+    def parse(self, res: requests.Response) -> List[Event]:
+        data = res.json()
+        # newest first
+        return [Event(self.parse_date(e["fec_track"]).isoformat(timespec='seconds'), e['gls_tracking'])
+                for e in reversed(data['ListTracking'])]
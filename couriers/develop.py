@@ -0,0 +1,17 @@
+import random as rnd
+from dataclasses import dataclass
+from typing import List
+
+from classes import Event, RawDataScrapper
+
+
+@dataclass
+class DevDataScrapper(RawDataScrapper):
+    last: str = ''
+
+    def get_events(self) -> List[Event]:
+        from coolname import generate_slug
+
+        length = rnd.randint(2, 4)  # coolname has no slugs longer than 4 words
+        self.last = rnd.choice([self.last or generate_slug(4), generate_slug(length)])
+        return [Event('', self.last)]
@@ -0,0 +1,31 @@
+import re
+from datetime import datetime
+from typing import List
+
+import requests
+
+from classes import Event, RawDataScrapper, status_pattern
+
+
+class PullmanBusCargoRaw(RawDataScrapper):
+    cod: str
+
+    code_pattern = re.compile(r'\d{6,10}')
+    terminal_pattern = status_pattern('entregado', 'entregado a destinatario', 'devuelto a origen')
+
+    @staticmethod
+    def parse_date(text: str) -> str:
+        try:
+            return datetime.strptime(text, '%d-%m-%Y %H:%M').isoformat()
+        except ValueError:
+            return text
+
+    def get_events(self) -> List[Event]:
+        return self.request_events(
+            "POST",
+            f'http://www.pullmancargo.cl/WEB/cuentacorrientecarga/funciones/ajax2.php?op=consultaodt&odt={self.cod}',
+            self.parse)
+
+    def parse(self, res: requests.Response) -> List[Event]:
+        # newest first
+        return [Event(self.parse_date(e['FECHA']), e['estadoweb'], e['AGENCIA']) for e in reversed(res.json())]
@@ -0,0 +1,30 @@
+import re
+from datetime import datetime
+from typing import List
+
+import requests
+
+from classes import Event, RawDataScrapper, status_pattern
+
+
+class StarkenRaw(RawDataScrapper):
+    cod: str
+
+    code_pattern = re.compile(r'\d{8,12}')
+    terminal_pattern = status_pattern('entregado', 'entregada', 'devuelto a origen')
+
+    session_headers = {'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:78.0) Gecko/20100101 Firefox/78.0'}
+
+    def warm_up(self, s: requests.Session):
+        s.get("https://www.starken.cl/seguimiento", timeout=self.timeout)
+
+    def get_events(self) -> List[Event]:
+        return self.request_events("GET", f"https://gateway.starken.cl/tracking/orden-flete-dte/of/{self.cod}",
+                                   self.parse)
+
+    @staticmethod
+    def parse(res: requests.Response) -> List[Event]:
+        data = res.json()
+        updated_at = datetime.strptime(data["updated_at"], '%Y-%m-%dT%H:%M:%S.%fZ')
+
+        return [Event(updated_at.isoformat(timespec='seconds'), data['status'])]
@@ -0,0 +1,57 @@
+import re
+from typing import Dict, List, Mapping
+
+import requests
+
+from classes import Event, RawDataScrapper, ScrapeResult, status_pattern
+
+
+class UPSRaw(RawDataScrapper):
+    code_pattern = re.compile(r'1Z[0-9A-Z]{16}', re.IGNORECASE)
+    terminal_pattern = status_pattern('entregado', 'delivered', 'devuelto al remitente', 'returned to sender')
+
+    def warm_up(self, s: requests.Session):
+        s.get("https://www.ups.com/track?loc=es_CL&requester=ST/", timeout=self.timeout)
+
+    def request_headers(self, s: requests.Session) -> Mapping[str, str]:
+        return {
+            'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10.15; rv:92.0) Gecko/20100101 Firefox/92.0',
+            'Accept': 'application/json, text/plain, */*',
+            'Accept-Language': 'es-CL,es;q=0.8,en-US;q=0.5,en;q=0.3',
+            'Referer': 'https://www.ups.com/track?loc=es_CL&requester=ST/',
+            'X-XSRF-TOKEN': s.cookies.get("X-XSRF-TOKEN-ST"),
+            'Origin': 'https://www.ups.com',
+            'DNT': '1',
+            'Connection': 'keep-alive',
+            'Sec-Fetch-Dest': 'empty',
+            'Sec-Fetch-Mode': 'cors',
+            'Sec-Fetch-Site': 'same-origin',
+            'Sec-GPC': '1',
+            'Pragma': 'no-cache',
+            'Cache-Control': 'no-cache',
+        }
+
+    max_batch = 25
+
+    @classmethod
+    def fetch_many(cls, codes: List[str]) -> Dict[str, ScrapeResult]:
+        if len(codes) == 1:
+            return {codes[0]: cls(codes[0]).get_events()}
+
+        data = {"Locale": "es_CL", "TrackingNumber": codes}
+
+        response = cls(codes[0]).request("POST", 'https://www.ups.com/track/api/Track/GetStatus?loc=es_CL', json=data)
+        details = {d['trackingNumber'].upper(): d for d in response.json()['trackDetails']}
+        return {code: [Event('', details[code.upper()]['packageStatus'])] if code.upper() in details
+                else KeyError(f"{code} not in UPS response") for code in codes}
+
+    def get_events(self) -> List[Event]:
+        data = {"Locale": "es_CL", "TrackingNumber": [self.cod]}
+        return self.request_events("POST", 'https://www.ups.com/track/api/Track/GetStatus?loc=es_CL', self.parse,
+                                   json=data)
+
+    @staticmethod
+    def parse(response: requests.Response) -> List[Event]:
+        result = response.json()
+        # the status api gives no timestamp, events are told apart by their status
+        return [Event('', result['trackDetails'][-1]['packageStatus'])]
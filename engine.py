@@ -0,0 +1,139 @@
+import asyncio
+import concurrent.futures
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor, Future
+from typing import Callable, Dict, List, Optional, Tuple, Type
+
+from classes import RawDataScrapper, ScrapeResult
+from limits import CourierLimits, CircuitOpenError, is_courier_failure
+from metrics import SCRAPE, SCRAPE_ERRORS
+
+ScrapeCallback = Callable[[ScrapeResult], None]
+CodeCallback = Callable[[str, ScrapeResult], None]
+
+
+class ScrapeEngine:
+    """
+    Runs scrappers concurrently on a background asyncio loop, limiting in-flight requests per courier
+    so a slow courier only stalls its own subscriptions.
+    """
+
+    def __init__(self, limits: Optional[Dict[str, int]] = None, default_limit: int = 8, max_workers: int = 32,
+                 guards: Optional[CourierLimits] = None, defaults: Optional[Callable[[str], Optional[int]]] = None):
+        self.limits = limits or {}
+        # concurrency of the couriers missing from `limits`, `default_limit` when it returns None
+        self.defaults = defaults
+        self.guards = guards or CourierLimits()
+        self.default_limit = default_limit
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="scrapper")
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name="scrape-engine", daemon=True)
+        self.semaphores: Dict[str, asyncio.Semaphore] = {}
+        self.in_flight: set = set()
+        self.lock = threading.Lock()
+
+    def start(self):
+        if not self.thread.is_alive():
+            self.thread.start()
+
+    def stop(self, timeout: float = 30):
+        """Wait up to `timeout` for submitted scrapes and their callbacks to finish, then stop the loop"""
+        with self.lock:
+            pending = list(self.in_flight)
+        concurrent.futures.wait(pending, timeout=timeout)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.executor.shutdown(wait=True)
+
+    def _track(self, future: Future) -> Future:
+        with self.lock:
+            self.in_flight.add(future)
+        future.add_done_callback(self._untrack)
+        return future
+
+    def _untrack(self, future: Future):
+        with self.lock:
+            self.in_flight.discard(future)
+
+    def _semaphore(self, courier: str) -> asyncio.Semaphore:
+        # only called from the loop thread, so the semaphore is bound to the engine loop
+        if courier not in self.semaphores:
+            limit = self.limits.get(courier)
+            if limit is None and self.defaults is not None:
+                limit = self.defaults(courier)
+            self.semaphores[courier] = asyncio.Semaphore(limit or self.default_limit)
+        return self.semaphores[courier]
+
+    async def _guarded(self, courier: str):
+        """Wait for a rate limit token, False if the courier circuit is open and the scrape must be skipped"""
+        if not self.guards.breaker(courier).allow():
+            return False
+        await asyncio.sleep(self.guards.reserve(courier))
+        return True
+
+    async def scrape(self, courier: str, scrapper: RawDataScrapper) -> ScrapeResult:
+        async with self._semaphore(courier):
+            if not await self._guarded(courier):
+                return CircuitOpenError(courier)
+            try:
+                with SCRAPE.time(courier=courier):
+                    result = await scrapper.get_events_async(self.executor)
+            except Exception as e:
+                SCRAPE_ERRORS.inc(courier=courier, error=type(e).__name__)
+                self.guards.breaker(courier).record(not is_courier_failure(e))
+                return e
+            self.guards.breaker(courier).record(True)
+            return result
+
+    async def scrape_many(self, items: List[Tuple[str, RawDataScrapper]]) -> List[ScrapeResult]:
+        return list(await asyncio.gather(*[self.scrape(courier, scrapper) for courier, scrapper in items]))
+
+    async def _scrape_and_call(self, courier: str, scrapper: RawDataScrapper, callback: ScrapeCallback):
+        result = await self.scrape(courier, scrapper)
+        # callbacks usually talk to telegram, keep them off the event loop
+        await self.loop.run_in_executor(self.executor, callback, result)
+
+    def submit(self, courier: str, scrapper: RawDataScrapper, callback: ScrapeCallback) -> Future:
+        """Schedule a scrape from any thread, `callback` receives the data or the raised exception"""
+        return self._track(asyncio.run_coroutine_threadsafe(self._scrape_and_call(courier, scrapper, callback),
+                                                            self.loop))
+
+    async def scrape_batch(self, courier: str, scrapper_cls: Type[RawDataScrapper],
+                           codes: List[str]) -> Dict[str, ScrapeResult]:
+        async with self._semaphore(courier):
+            if not await self._guarded(courier):
+                return {code: CircuitOpenError(courier) for code in codes}
+            try:
+                with SCRAPE.time(courier=courier):
+                    results = await self.loop.run_in_executor(self.executor, scrapper_cls.get_events_many, codes)
+            except Exception as e:
+                results = {code: e for code in codes}
+            for e in results.values():
+                if isinstance(e, Exception):
+                    SCRAPE_ERRORS.inc(courier=courier, error=type(e).__name__)
+            failed = all(isinstance(r, Exception) and is_courier_failure(r) for r in results.values())
+            self.guards.breaker(courier).record(not failed)
+            return results
+
+    async def _scrape_batch_and_call(self, courier: str, scrapper_cls: Type[RawDataScrapper], codes: List[str],
+                                     callback: CodeCallback):
+        results = await self.scrape_batch(courier, scrapper_cls, codes)
+        await asyncio.gather(*[self.loop.run_in_executor(self.executor, callback, code, result)
+                               for code, result in results.items()])
+
+    def submit_many(self, courier: str, scrapper_cls: Type[RawDataScrapper], codes: List[str],
+                    callback: CodeCallback) -> List[Future]:
+        """
+        Schedule the lookup of several codes of a courier: one request per `max_batch` codes when the courier
+        supports batching, concurrent single scrapes otherwise. `callback` receives each code and its result.
+        """
+        if scrapper_cls.max_batch <= 1:
+            return [self.submit(courier, scrapper_cls(code), functools.partial(callback, code)) for code in codes]
+        return [self._track(asyncio.run_coroutine_threadsafe(
+            self._scrape_batch_and_call(courier, scrapper_cls, codes[i:i + scrapper_cls.max_batch], callback),
+            self.loop)) for i in range(0, len(codes), scrapper_cls.max_batch)]
+
+    def run(self, items: List[Tuple[str, RawDataScrapper]]) -> List[ScrapeResult]:
+        """Blocking runner: scrape every (courier, scrapper) pair concurrently and return results in order"""
+        return asyncio.run_coroutine_threadsafe(self.scrape_many(items), self.loop).result()
@@ -0,0 +1,99 @@
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+from classes import Event
+from peewee import fn
+
+from models import EventModel, db
+from scheduler import PollKey
+
+
+class EventStore:
+    """
+    Tracking history of every polled (courier, cod), appended to EventModel. Only the events
+    after the last one seen are new, so a poll is diffed against a single remembered event and
+    the stored history is only read when the courier rewrote it (or for keys unknown before `load`).
+    Events without a time only tell the current status, so they are new whenever they differ from
+    the last one, even if the parcel had that status before. New events are written behind by `flush`.
+    """
+
+    def __init__(self):
+        self.last: Dict[PollKey, Event] = {}
+        self.pending: List[Tuple[PollKey, Event, float]] = []
+        # after `load` a key missing from `last` has no stored history
+        self.loaded = False
+        self.lock = threading.Lock()
+
+    def load(self) -> int:
+        """Remember the latest stored event of every key, returns how many keys have a history"""
+        latest = EventModel.select(fn.MAX(EventModel.id)).group_by(EventModel.courier, EventModel.cod)
+        rows = EventModel.select().where(EventModel.id.in_(latest))
+        with self.lock:
+            for row in rows:
+                self.last.setdefault((row.courier, row.cod), Event(row.event_ts, row.status, row.location))
+            self.loaded = True
+            return len(self.last)
+
+    @staticmethod
+    def stored(key: PollKey) -> List[Event]:
+        courier, cod = key
+        rows = (EventModel.select()
+                .where((EventModel.courier == courier) & (EventModel.cod == cod))
+                .order_by(EventModel.event_ts, EventModel.id))
+        return [Event(row.event_ts, row.status, row.location) for row in rows]
+
+    @staticmethod
+    def latest(key: PollKey) -> Optional[Event]:
+        courier, cod = key
+        row = (EventModel.select()
+               .where((EventModel.courier == courier) & (EventModel.cod == cod))
+               .order_by(EventModel.id.desc())
+               .first())
+        return None if row is None else Event(row.event_ts, row.status, row.location)
+
+    def record(self, key: PollKey, events: List[Event]) -> Tuple[List[Event], bool]:
+        """Append the events not seen before, returns them and whether the key had any history"""
+        with self.lock:
+            last = self.last.get(key)
+        if last is not None and len(events) > 0 and events[-1] is last:
+            # the scrapper reused the previous response
+            return [], True
+        if len(events) > 0 and events[-1].timestamp == '':
+            if last is None and not self.loaded:
+                last = self.latest(key)
+            new = [] if events[-1] == last else events[-1:]
+            known = last is not None
+        elif last is not None and last in events:
+            new = events[events.index(last) + 1:]
+            known = True
+        else:
+            history = set() if last is None and self.loaded else set(self.stored(key))
+            with self.lock:
+                history.update(event for pending_key, event, _ in self.pending if pending_key == key)
+            new = [event for event in events if event not in history]
+            known = len(history) > 0
+        if len(events) > 0:
+            now = time.time()
+            with self.lock:
+                self.last[key] = events[-1]
+                self.pending.extend((key, event, now) for event in new)
+        return new, known
+
+    def flush(self) -> int:
+        with self.lock:
+            pending, self.pending = self.pending, []
+        if len(pending) == 0:
+            return 0
+        try:
+            with db.atomic():
+                for (courier, cod), event, seen_at in pending:
+                    (EventModel.insert(courier=courier, cod=cod, event_ts=event.timestamp, status=event.status,
+                                       location=event.location, seen_at=seen_at)
+                     .on_conflict_ignore()
+                     .execute())
+        except Exception:
+            with self.lock:
+                self.pending = pending + self.pending
+            raise
+        return len(pending)
@@ -0,0 +1,83 @@
+import csv
+import io
+import json
+import tempfile
+from typing import Any, BinaryIO, Callable, Dict, Iterable, List
+
+from playhouse.postgres_ext import PostgresqlExtDatabase, ServerSide
+
+from models import EventModel, JobModel, db
+
+STATE_COLUMNS = ['desc', 'courier', 'cod', 'delta', 'last_update']
+HISTORY_COLUMNS = ['desc', 'courier', 'cod', 'event_ts', 'location', 'status']
+
+
+def stream(query) -> Iterable[Dict[str, Any]]:
+    """Rows of `query` read from the cursor as they are consumed instead of cached in the query"""
+    if isinstance(db.obj, PostgresqlExtDatabase):
+        # psycopg2 fetches the whole result of a client-side cursor, named cursors need a transaction
+        with db.atomic():
+            yield from ServerSide(query.dicts())
+    else:
+        yield from query.dicts().iterator()
+
+
+def state_rows(chat_id) -> Iterable[Dict[str, Any]]:
+    query = (JobModel.select(JobModel.desc, JobModel.courier, JobModel.cod, JobModel.delta, JobModel.last_update)
+             .where(JobModel.chat_id == str(chat_id))
+             .order_by(JobModel.courier, JobModel.cod))
+    return stream(query)
+
+
+def history_rows(chat_id) -> Iterable[Dict[str, Any]]:
+    query = (EventModel.select(JobModel.desc, EventModel.courier, EventModel.cod, EventModel.event_ts,
+                               EventModel.location, EventModel.status)
+             .join(JobModel, on=((EventModel.courier == JobModel.courier) & (EventModel.cod == JobModel.cod)))
+             .where(JobModel.chat_id == str(chat_id))
+             .order_by(EventModel.courier, EventModel.cod, JobModel.name, EventModel.event_ts, EventModel.id))
+    return stream(query)
+
+
+def write_csv(rows: Iterable[Dict[str, Any]], columns: List[str], fp: io.TextIOBase):
+    writer = csv.DictWriter(fp, columns, extrasaction='ignore')
+    writer.writeheader()
+    for row in rows:
+        writer.writerow(row)
+
+
+def write_json(rows: Iterable[Dict[str, Any]], columns: List[str], fp: io.TextIOBase):
+    fp.write('[')
+    for i, row in enumerate(rows):
+        fp.write(',\n' if i else '\n')
+        fp.write(json.dumps({c: row.get(c) for c in columns}, ensure_ascii=False))
+    fp.write('\n]\n')
+
+
+class Utf8Writer(io.TextIOBase):
+    """Encodes text into a binary file, SpooledTemporaryFile can't be wrapped in a TextIOWrapper before 3.11"""
+
+    def __init__(self, fp: BinaryIO):
+        super().__init__()
+        self.fp = fp
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, text: str) -> int:
+        self.fp.write(text.encode('utf-8'))
+        return len(text)
+
+
+writers: Dict[str, Callable[[Iterable[Dict[str, Any]], List[str], io.TextIOBase], None]] = {
+    "csv": write_csv,
+    "json": write_json,
+}
+
+
+def export(rows: Iterable[Dict[str, Any]], columns: List[str], fmt: str = "csv",
+           max_memory: int = 1024 * 1024) -> BinaryIO:
+    """Write `rows` as they are read into a file kept in memory up to `max_memory` bytes, then on disk"""
+    fp = tempfile.SpooledTemporaryFile(max_size=max_memory)
+    writers[fmt](rows, columns, Utf8Writer(fp))
+    fp.seek(0)
+    return fp
@@ -0,0 +1,146 @@
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, Mapping, Optional, TypeVar
+
+import requests
+
+T = TypeVar('T')
+
+
+class CircuitOpenError(Exception):
+    """The courier circuit is open, the poll was skipped without calling the courier"""
+
+
+def is_courier_failure(e: BaseException) -> bool:
+    """Network errors, timeouts and non json answers count against the courier, parse errors of a bad code do not"""
+    return isinstance(e, (requests.RequestException, ValueError)) and not isinstance(e, CircuitOpenError)
+
+
+@dataclass
+class TokenBucket:
+    rate: float  # tokens per second
+    burst: int
+    tokens: float = field(init=False)
+    updated: float = field(init=False, default_factory=time.monotonic)
+    lock: threading.Lock = field(init=False, default_factory=threading.Lock, repr=False)
+
+    def __post_init__(self):
+        self.tokens = float(self.burst)
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(float(self.burst), self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self) -> float:
+        """Take a token and return how many seconds the caller must wait before using it"""
+        with self.lock:
+            self._refill()
+            self.tokens -= 1
+            return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def try_acquire(self) -> bool:
+        """Take a token only if one is available right now"""
+        with self.lock:
+            self._refill()
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+    def refund(self):
+        with self.lock:
+            self.tokens = min(float(self.burst), self.tokens + 1)
+
+
+@dataclass
+class CircuitBreaker:
+    failure_threshold: int = 5
+    reset_timeout: float = 60
+    failures: int = 0
+    opened_at: Optional[float] = None
+    probing: bool = False
+    lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        return "half-open" if self.probing or time.monotonic() - self.opened_at >= self.reset_timeout else "open"
+
+    def allow(self) -> bool:
+        """Closed lets everything through, open nothing, and half-open a single probe at a time"""
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if self.probing or time.monotonic() - self.opened_at < self.reset_timeout:
+                return False
+            self.probing = True
+            return True
+
+    def record(self, success: bool):
+        with self.lock:
+            self.probing = False
+            if success:
+                self.failures = 0
+                self.opened_at = None
+                return
+            self.failures += 1
+            if self.failures >= self.failure_threshold or self.opened_at is not None:
+                self.opened_at = time.monotonic()
+
+
+class CourierLimits:
+    """
+    Rate limit and circuit breaker state of every courier, shared by all the jobs polling it.
+
+    `rate_limits` maps courier name to {"rate": requests per second, "burst": bucket size},
+    couriers without an entry get the limit given by `defaults`, or are not rate limited.
+    """
+
+    def __init__(self, rate_limits: Optional[Mapping[str, Mapping[str, Any]]] = None,
+                 breaker: Optional[Mapping[str, Any]] = None,
+                 defaults: Optional[Callable[[str], Optional[Mapping[str, Any]]]] = None):
+        self.rate_limits = rate_limits or {}
+        self.breaker_config = breaker or {}
+        self.defaults = defaults
+        self.buckets: Dict[str, Optional[TokenBucket]] = {}
+        self.breakers: Dict[str, CircuitBreaker] = {}
+        self.lock = threading.Lock()
+
+    def bucket(self, courier: str) -> Optional[TokenBucket]:
+        with self.lock:
+            if courier not in self.buckets:
+                conf = self.rate_limits.get(courier)
+                if conf is None and self.defaults is not None:
+                    conf = self.defaults(courier)
+                self.buckets[courier] = None if conf is None else TokenBucket(float(conf["rate"]),
+                                                                              int(conf.get("burst", 1)))
+            return self.buckets[courier]
+
+    def breaker(self, courier: str) -> CircuitBreaker:
+        with self.lock:
+            if courier not in self.breakers:
+                self.breakers[courier] = CircuitBreaker(
+                    failure_threshold=self.breaker_config.get("failures", 5),
+                    reset_timeout=self.breaker_config.get("reset_timeout", 60))
+            return self.breakers[courier]
+
+    def reserve(self, courier: str) -> float:
+        bucket = self.bucket(courier)
+        return 0.0 if bucket is None else bucket.reserve()
+
+    def call(self, courier: str, fn: Callable[[], T]) -> T:
+        """Blocking guarded call, raises CircuitOpenError instead of calling `fn` while the circuit is open"""
+        breaker = self.breaker(courier)
+        if not breaker.allow():
+            raise CircuitOpenError(courier)
+        time.sleep(self.reserve(courier))
+        try:
+            result = fn()
+        except Exception as e:
+            breaker.record(not is_courier_failure(e))
+            raise
+        breaker.record(True)
+        return result
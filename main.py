@@ -1,10 +1,20 @@
+import argparse
+import collections
+import csv
+import functools
 import json
 import logging
+import os
 import pathlib
 import random as rnd
+import re
+import signal
+import socket
 import string
+import threading
+import time as timer
 import uuid
-from typing import Callable, Dict, Iterator, Optional, Tuple, TypeVar, Any
+from typing import Callable, Dict, Iterator, List, Optional, Set, Tuple, Type
 
 # noinspection PyPackageRequirements
 import telegram.ext
@@ -12,14 +22,27 @@ import telegram.ext
 # noinspection PyPackageRequirements
 from telegram import ReplyKeyboardRemove, ReplyKeyboardMarkup, InlineKeyboardMarkup, InlineKeyboardButton
 # noinspection PyPackageRequirements
-from telegram.ext import Updater, Job, ConversationHandler, CommandHandler, MessageHandler, Filters, \
+from telegram.ext import Updater, ConversationHandler, CommandHandler, MessageHandler, Filters, \
     CallbackQueryHandler
 
 # Enable logging
 # noinspection PyUnresolvedReferences
-from classes import RawDataScrapper, DevDataScrapper, BluexRaw, PullmanBusCargoRaw, StarkenRaw, ChileExpressRaw, UPSRaw
-from models import JobModel
-from tables import old_generate_image
+from cache import ResultCache
+from classes import TERMINAL, RawDataScrapper, ScrapeResult
+from couriers import DEFAULT_COURIERS, DEV_COURIERS, CourierRegistry
+from engine import ScrapeEngine
+from events import EventStore
+from export import HISTORY_COLUMNS, STATE_COLUMNS, export, history_rows, state_rows, writers
+from limits import CourierLimits, CircuitOpenError
+from metrics import CHECK_UPDATE, JOBS_RECOVERED, MESSAGES_SENT, POLL_LAG, RECOVERY_DONE, SCRAPE, SCRAPE_ERRORS, \
+    SEND, SEND_ERRORS, Gauge, \
+    registry as metrics_registry, serve as serve_metrics
+from models import DEFAULT_URL, JobModel, JobRemovalModel, PollStateModel, connect, db
+from outbox import Outbox
+from registry import JobRegistry
+from scheduler import PollScheduler, PollKey, PollState, Subscriber
+from sharding import ShardCoordinator, key_hash, shard_of, shard_sql
+from tables import ImageCache, renderers, text_table
 
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
                     level=logging.INFO)
@@ -30,7 +53,7 @@ logger = logging.getLogger(__name__)
 
 path = pathlib.Path(__file__).parent.absolute()
 
-with open(path.joinpath('config.json'), 'r') as f:
+with open(os.environ.get('CHILE_COURIER_BOT_CONFIG', path.joinpath('config.json')), 'r') as f:
     config = json.load(f)
 
 SELECT_CURRIER, SELECT_TIME, SELECT_CODE, ENTER_DESC, JOB_CANCEL, SELECT_JOB = range(6)
@@ -45,23 +68,61 @@ time_dict = {
     "24hr": 24 * 3600
 }
 
+POLL_TICK = config.get("POLL_TICK", 5)
+FLUSH_INTERVAL = config.get("FLUSH_INTERVAL", 10)
+# seconds over which the overdue polls are spread at startup, the interval of each key when unset
+STARTUP_SPREAD = config.get("STARTUP_SPREAD")
+# jobs are loaded in the background after startup, this many per query
+RECOVERY_CHUNK = config.get("RECOVERY_CHUNK", 1000)
+# /bulk_subscribe: most codes per message or file, and seconds over which their first polls are spread
+BULK_MAX_CODES = config.get("BULK_MAX_CODES", 500)
+BULK_SPREAD = config.get("BULK_SPREAD", 60)
+BULK_DEFAULT_TIME = config.get("BULK_DEFAULT_TIME", "1hr")
+# a bulk line: the code, the separator after it and the rest
+BULK_CODE = re.compile(r'([^\s,]+)([\s,]?)(.*)')
+SHUTDOWN_TIMEOUT = config.get("SHUTDOWN_TIMEOUT", 30)
+# sharded deployment: one front process handles telegram updates, worker processes split the polling
+SHARDS = config.get("SHARDS", 64)
+LEASE_TTL = config.get("LEASE_TTL", 30)
+HEARTBEAT_INTERVAL = config.get("HEARTBEAT_INTERVAL", 10)
+# seconds the removals of jobs are kept for the workers to sync them
+REMOVAL_RETENTION = config.get("REMOVAL_RETENTION", 3600)
+# one of tables.renderers or "text" for a monospace message
+TABLE_RENDERER = config.get("TABLE_RENDERER", "matplotlib")
+TELEGRAM_MESSAGE_LIMIT = 4096
+# larger subscription lists are sent as text instead of rendering a huge image
+SUBSCRIPTIONS_IMAGE_MAX = config.get("SUBSCRIPTIONS_IMAGE_MAX", 50)
+
+# playhouse.db_url URL, a postgresql(+pool) one lets the processes of a sharded deployment write concurrently.
+# Apply the schema with `python -m migrations` first
+connect(config.get("DATABASE", DEFAULT_URL))
+
+# COURIERS adds couriers ({"Name": "module:Class"}) or removes default ones ({"Name": null})
+dispatcher = CourierRegistry(DEV_COURIERS if config["DEV"] else {**DEFAULT_COURIERS, **config.get("COURIERS", {})})
+
+scheduler = PollScheduler(adaptive=config.get("ADAPTIVE_POLLING", False),
+                          max_backoff=config.get("ADAPTIVE_MAX_BACKOFF", 32),
+                          on_dispatch=lambda key, lag: POLL_LAG.observe(lag))
+registry = JobRegistry()
+result_cache = ResultCache(ttls=config.get("RESULT_CACHE_TTL", {}),
+                           default_ttl=config.get("DEFAULT_RESULT_CACHE_TTL", 30))
+event_store = EventStore()
+image_cache = ImageCache(max_bytes=config.get("IMAGE_CACHE_BYTES", 32 * 1024 * 1024))
+guards = CourierLimits(rate_limits=config.get("RATE_LIMITS", {}), breaker=config.get("CIRCUIT_BREAKER", {}),
+                       defaults=lambda courier: dispatcher[courier].rate_limit if courier in dispatcher else None)
+outbox = Outbox(global_rate=config.get("OUTBOX_GLOBAL_RATE", 25),
+                chat_rate=config.get("OUTBOX_CHAT_RATE", 1),
+                window=config.get("OUTBOX_COALESCE_WINDOW", 2),
+                workers=config.get("OUTBOX_WORKERS", 4))
+engine = ScrapeEngine(limits=config.get("COURIER_CONCURRENCY", {}),
+                      default_limit=config.get("DEFAULT_COURIER_CONCURRENCY", 8),
+                      max_workers=config.get("SCRAPE_WORKERS", 32),
+                      guards=guards,
+                      defaults=lambda courier: dispatcher[courier].concurrency if courier in dispatcher else None)
+
 keyboard_time_keyboard = [[k] for k in time_dict.keys()]
 time_regex = f"^({'|'.join(time_dict.keys())})$"
 
-DataScrapperType = TypeVar('DataScrapperType', bound=RawDataScrapper)
-
-if config["DEV"]:
-    dispatcher: Dict[str, Callable[[str], DataScrapperType]] = {
-        'develop': lambda code: DevDataScrapper(code)
-    }
-else:
-    dispatcher: Dict[str, Callable[[str], DataScrapperType]] = {
-        'Chilexpress': lambda code: ChileExpressRaw(code),
-        'Bluex': lambda code: BluexRaw(code),
-        'PullmanBusCargo': lambda code: PullmanBusCargoRaw(code),
-        'Starken': lambda code: StarkenRaw(code),
-        'UPS': lambda code: UPSRaw(code)
-    }
 keyboard_currier_keyboard = [[k] for k in dispatcher.keys()]
 currier_regex = f"^({'|'.join(dispatcher.keys())})$"
 
@@ -73,8 +134,10 @@ def start(update: telegram.Update, context: telegram.ext.CallbackContext):
                               'Supported Couriers: Chilexpress, Bluex, PullmanBusCargo, Starken \n'
                               'Posible Commands: \n'
                               '/subscribe : subscribe to a courier tracking with code \n'
+                              '/bulk_subscribe : subscribe to many codes at once, one per line or a CSV file \n'
                               '/shut_up : stop subscription \n'
                               '/subscriptions : list subscriptions\n'
+                              '/export [csv|json] [history] : subscriptions or their tracking history as a file\n'
                               '/force_get : get current state of tracking'
                               )
     logger.info(update.message)  # INIT: host the bot , send a /start , add chat_id (on this log) to whitelist
@@ -85,8 +148,10 @@ def help(update: telegram.Update, context: telegram.ext.CallbackContext):
     """Send a message when the command /help is issued."""
     update.message.reply_text('Posible Commands: \n'
                               '/subscribe : subscribe to a courier tracking with code \n'
+                              '/bulk_subscribe : subscribe to many codes at once, one per line or a CSV file \n'
                               '/shut_up : stop subscription \n'
                               '/subscriptions : list subscriptions \n'
+                              '/export [csv|json] [history] : subscriptions or their tracking history as a file \n'
                               '/force_get : get current state of tracking \n'
                               'Supported Couriers: Chilexpress, Bluex, PullmanBusCargo, Starken')
 
@@ -112,14 +177,12 @@ def generate_key():
 
 
 def get_current_jobs(chat_id):
-    return JobModel.select().where(JobModel.chat_id == chat_id)
+    return registry.for_chat(chat_id)
 
 
-def register_job(job_fn: Callable[[str], Job], update: telegram.Update, delta, courier, code, desc) -> str:
-    current_jobs = get_current_jobs(chat_id=update.message.chat_id)
-    keys = [j.name for j in current_jobs]
+def register_job(job_fn: Callable[[str], None], update: telegram.Update, delta, courier, code, desc) -> str:
     key = generate_key()
-    while key in keys:
+    while registry.get(update.message.chat_id, key) is not None:
         key = generate_key()
 
     job_db = JobModel.create(id=str(uuid.uuid4()),
@@ -129,22 +192,32 @@ def register_job(job_fn: Callable[[str], Job], update: telegram.Update, delta, c
                              courier=courier,
                              cod=code,
                              desc=desc,
-                             last_update=None)
+                             last_update=None,
+                             key_hash=key_hash((courier, code)))
     job_db.save()
+    registry.add(job_db)
     job_fn(str(key))
 
     return str(key)
 
 
+# noinspection PyUnusedLocal
 def cancel_job(name: str, update: telegram.Update, context: telegram.ext.CallbackContext) -> Tuple[bool, Optional[str]]:
-    job = context.job_queue.get_jobs_by_name(name)
-    if len(job) == 0:
+    chat_id = str(update.effective_message.chat_id)
+    job_db: Optional[JobModel] = registry.get(chat_id, name)
+    if job_db is None:
         return False, None
 
-    job[0].schedule_removal()  # TODO: check if job is already terminated
-    job_db: JobModel = JobModel.get(JobModel.chat_id == update.effective_message.chat_id, JobModel.name == name)
+    # the poller of the job may live in a worker process, in which case the scheduler here has no group
+    scheduler.unsubscribe((job_db.courier, job_db.cod), (chat_id, name))
     key = f"{job_db.courier.upper()} {job_db.cod}"
-    job_db.delete_instance()
+    registry.remove(chat_id, name)
+    with db.atomic():
+        job_db.delete_instance()
+        if registry.read_through:
+            # the worker polling the job drops it on its next shard sync
+            JobRemovalModel.create(job_id=job_db.id, chat_id=chat_id, name=name,
+                                   key_hash=key_hash((job_db.courier, job_db.cod)), removed_at=timer.time())
     return True, key
 
 
@@ -159,11 +232,13 @@ def get_jobs_inline(update: telegram.Update):
 
 
 # noinspection PyUnusedLocal
+@db.connection_context()
 def shut_up(update: telegram.Update, context: telegram.ext.CallbackContext):
     get_jobs_inline(update)
     return JOB_CANCEL
 
 
+@db.connection_context()
 def shut_up_get_job_name(update: telegram.Update, context: telegram.ext.CallbackContext):
     name = update.callback_query.data
     val, key = cancel_job(name, update, context)
@@ -172,18 +247,70 @@ def shut_up_get_job_name(update: telegram.Update, context: telegram.ext.Callback
     return ConversationHandler.END
 
 
+def send_text_table(update: telegram.Update, table, columns):
+    lines = text_table(table, columns).splitlines()
+    chunk = []
+    for line in lines:
+        if len('\n'.join(chunk + [line])) + 8 > TELEGRAM_MESSAGE_LIMIT:
+            update.message.reply_text('```\n' + '\n'.join(chunk) + '\n```', parse_mode=telegram.ParseMode.MARKDOWN)
+            chunk = []
+        chunk.append(line)
+    update.message.reply_text('```\n' + '\n'.join(chunk) + '\n```', parse_mode=telegram.ParseMode.MARKDOWN)
+
+
 # noinspection PyUnusedLocal
+@db.connection_context()
 def get_subscriptions(update: telegram.Update, context: telegram.ext.CallbackContext):
     current_jobs: Iterator[JobModel] = get_current_jobs(update.message.chat_id)
     table = []
     for job in current_jobs:
-        table.append([job.desc if job.desc is not None else '(null)', job.courier.upper(), job.cod, job.last_update])
+        cached = result_cache.peek((job.courier, job.cod))
+        state = dispatcher[job.courier].summarize(cached[0]) if cached is not None else job.last_update
+        table.append([job.desc if job.desc is not None else '(null)', job.courier.upper(), job.cod, state])
+    columns = ['Description', 'Courier', 'Code', 'Last Update']
+    if TABLE_RENDERER == "text" or len(table) > SUBSCRIPTIONS_IMAGE_MAX:
+        send_text_table(update, table, columns)
+        return ConversationHandler.END
+
+    key = image_cache.key(table, columns)
+
+    file_id = image_cache.get_file_id(key)
+    if file_id is not None:
+        try:
+            update.message.reply_photo(file_id)
+            return ConversationHandler.END
+        except telegram.error.BadRequest:
+            image_cache.set_file_id(key, None)
+
     update.message.reply_text("Generating...")
-    table_image = old_generate_image(table, columns=['Description', 'Courier', 'Code', 'Last Update'])
-    update.message.reply_photo(table_image)
+    table_image = image_cache.render(key, table, columns, renderers[TABLE_RENDERER])
+    message = update.message.reply_photo(table_image)
+    if message is not None and message.photo:
+        image_cache.set_file_id(key, message.photo[-1].file_id)
     return ConversationHandler.END
 
 
+# noinspection PyUnusedLocal
+@db.connection_context()
+def export_subscriptions(update: telegram.Update, context: telegram.ext.CallbackContext):
+    """/export [csv|json] [history]: the subscriptions of the chat, or the events of their codes, as a file"""
+    args = [arg.lower() for arg in context.args or []]
+    fmt = next((arg for arg in args if arg in writers), "csv")
+    history = "history" in args
+    if not registry.read_through:
+        # rows still written behind would be missing from the database
+        registry.flush()
+        event_store.flush()
+
+    chat_id = update.message.chat_id
+    if history:
+        document = export(history_rows(chat_id), HISTORY_COLUMNS, fmt)
+    else:
+        document = export(state_rows(chat_id), STATE_COLUMNS, fmt)
+    with document:
+        update.message.reply_document(document, filename=f"{'history' if history else 'subscriptions'}.{fmt}")
+
+
 # noinspection PyUnusedLocal
 def subscribe(update: telegram.Update, context: telegram.ext.CallbackContext):
     update.message.reply_text(text=f"Please enter currier or /cancel",
@@ -217,6 +344,7 @@ def select_time(update: telegram.Update, context: telegram.ext.CallbackContext):
     return ENTER_DESC
 
 
+@db.connection_context()
 def enter_desc(update: telegram.Update, context: telegram.ext.CallbackContext):
     desc: str = update.message.text
     delta = context.user_data['delta']
@@ -228,96 +356,368 @@ def enter_desc(update: telegram.Update, context: telegram.ext.CallbackContext):
     del context.user_data['delta']
 
     def listen_currier_job_fn(name: str):
-        return context.job_queue.run_repeating(check_update,
-                                               interval=delta,
-                                               first=0,
-                                               context={"chat_id": chat_id, "name": name},
-                                               name=name)
+        scheduler.subscribe((currier, code), (str(chat_id), name), delta)
 
     register_job(listen_currier_job_fn, update, delta, currier, code, desc)
 
-    context.bot.send_message(chat_id=update.message.chat_id,
-                             text=f'Starting listen {currier.upper()} {code}')
+    send_message(context.bot, chat_id=update.message.chat_id, text=f'Starting listen {currier.upper()} {code}')
     return ConversationHandler.END
 
 
-def get_data(job: JobModel, context: telegram.ext.CallbackContext):
-    currier = job.courier
-    cod = job.cod
-    scrapper: Callable[[str], DataScrapperType] = dispatcher[currier]
+def parse_bulk(text: str) -> Tuple[Optional[str], List[Tuple[str, Optional[str], Optional[str]]], List[str]]:
+    """
+    Parse a /bulk_subscribe message or CSV file: an optional refresh time after the command, then one
+    `code[,description[,courier]]` per line (or the code, a space and the whole description).
+    Returns the refresh time, the (code, description, courier) entries, codes deduplicated, and the
+    quoted codes rejected for having spaces.
+    """
+    lines = text.splitlines()
+    time_text = None
+    if lines and lines[0].startswith('/'):
+        # what follows the command (and the time) on its line is the first entry
+        rest = lines.pop(0).split(None, 1)[1:]
+        if rest and rest[0].split(None, 1)[0] in time_dict:
+            time_text, *rest = rest[0].split(None, 1)
+        lines = rest + lines
+
+    entries, invalid = {}, []
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        if line.startswith('"'):
+            row = next(csv.reader([line]))
+        else:
+            # the code ends at the first space or comma, CSV rules only apply to what follows a comma
+            code, separator, rest = BULK_CODE.match(line).groups()
+            row = [code] + (next(csv.reader([rest]), []) if separator == ',' else [rest])
+        code = row[0].strip()
+        if not code or code.lower() == 'code':
+            continue  # CSV header
+        if any(c.isspace() for c in code):
+            invalid.append(code)
+            continue
+        desc = row[1].strip() if len(row) > 1 and row[1].strip() else None
+        courier = row[2].strip() if len(row) > 2 and row[2].strip() in dispatcher else None
+        entries.setdefault(code, (code, desc, courier))
+    return time_text, list(entries.values()), invalid
+
+
+def detect_couriers(codes: List[str]) -> Dict[str, Optional[str]]:
+    """
+    Courier of every code: the only one whose code format matches, else the first (in dispatcher order)
+    of the matching couriers that finds the code in a concurrent probe, None if no courier knows it.
+    """
+    detected: Dict[str, Optional[str]] = {}
+    probes: List[Tuple[str, str]] = []
+    for code in codes:
+        candidates = [name for name, scrapper in dispatcher.items() if scrapper.matches(code)]
+        if len(candidates) == 1:
+            detected[code] = candidates[0]
+        else:
+            detected[code] = None
+            probes.extend((code, name) for name in candidates)
+
+    results = engine.run([(name, dispatcher[name](code)) for code, name in probes])
+    for (code, name), result in zip(probes, results):
+        if detected[code] is None and not isinstance(result, Exception) and len(result) > 0:
+            detected[code] = name
+            # the first poll of the new job reuses the probe
+            result_cache.set((name, code), result)
+    return detected
+
+
+def register_jobs(chat_id: int, entries: List[Tuple[str, Optional[str], str]], delta: int) -> List[JobModel]:
+    """Insert the (code, description, courier) jobs of a chat in one transaction, their first polls spread"""
+    names = {job.name for job in registry.for_chat(chat_id)}
+    jobs = []
+    for code, desc, courier in entries:
+        key = generate_key()
+        while key in names:
+            key = generate_key()
+        names.add(key)
+        jobs.append(JobModel(id=str(uuid.uuid4()), name=key, chat_id=str(chat_id), delta=delta, courier=courier,
+                             cod=code, desc=desc, last_update=None, key_hash=key_hash((courier, code))))
+    with db.atomic():
+        for i in range(0, len(jobs), 100):
+            JobModel.insert_many([job.__data__ for job in jobs[i:i + 100]]).execute()
+
+    spacing = BULK_SPREAD / max(1, len(jobs))
+    for i, job in enumerate(jobs):
+        registry.add(job)
+        scheduler.subscribe((job.courier, job.cod), (job.chat_id, job.name), delta, first=i * spacing)
+    return jobs
+
+
+@db.connection_context()
+def bulk_subscribe(update: telegram.Update, context: telegram.ext.CallbackContext):
+    """/bulk_subscribe [refresh time] followed by codes, or a CSV file sent with it as caption"""
+    message = update.message
+    if message.document is not None:
+        content = bytes(message.document.get_file().download_as_bytearray()).decode('utf-8-sig', errors='replace')
+        time_text, _, _ = parse_bulk(message.caption or '')
+        _, entries, invalid = parse_bulk(content)
+    else:
+        time_text, entries, invalid = parse_bulk(message.text)
+
+    if len(entries) == 0 and len(invalid) == 0:
+        message.reply_text('Send /bulk_subscribe [refresh time] followed by one tracking code per line, '
+                           'optionally with a description after it, or a CSV file (code,description,courier) '
+                           'with /bulk_subscribe as caption')
+        return
+    if len(entries) > BULK_MAX_CODES:
+        message.reply_text(f'At most {BULK_MAX_CODES} codes at once')
+        return
+
+    subscribed = {(job.courier, job.cod) for job in registry.for_chat(message.chat_id)}
+    detected = detect_couriers([code for code, _, courier in entries if courier is None])
+    new, unknown, repeated = [], [], []
+    for code, desc, courier in entries:
+        courier = courier or detected[code]
+        if courier is None:
+            unknown.append(code)
+        elif (courier, code) in subscribed:
+            repeated.append(code)
+        else:
+            new.append((code, desc, courier))
+
+    jobs = register_jobs(message.chat_id, new, time_dict[time_text or BULK_DEFAULT_TIME]) if new else []
+    lines = [f'Listening {len(jobs)} codes:'] + [f'{job.courier.upper()} {job.cod}' for job in jobs]
+    if repeated:
+        lines.append(f'Already subscribed: {", ".join(repeated)}')
+    if unknown:
+        lines.append(f'Courier not found: {", ".join(unknown)}')
+    if invalid:
+        lines.append(f'Invalid codes: {", ".join(invalid)}')
+    chunk = []
+    for line in lines:
+        if len('\n'.join(chunk + [line])) > TELEGRAM_MESSAGE_LIMIT:
+            message.reply_text('\n'.join(chunk))
+            chunk = []
+        chunk.append(line)
+    message.reply_text('\n'.join(chunk))
+
+
+def fetch_data(currier: str, cod: str) -> str:
+    """The latest state of a code, "ERROR" when it could not be scraped. Raises CircuitOpenError"""
+    scrapper: Type[RawDataScrapper] = dispatcher[currier]
+    events = result_cache.get((currier, cod))
+    if events is not None:
+        return scrapper.summarize(events)
     instance = scrapper(cod)
     try:
-        new_data = instance.get_data()
+        with SCRAPE.time(courier=currier):
+            events = guards.call(currier, instance.get_events)
+        data = scrapper.summarize(events)
+    except CircuitOpenError:
+        # the courier is down, not the code
+        raise
     except Exception as e:
-        if job.last_update != "ERROR":
-            context.bot.send_message(chat_id=job.chat_id,
-                                     text=f"Error happening when trying to get data from {currier.upper()} {cod}"
-                                          f"\nThis would be a invalid code, expired code or courier page error")
+        SCRAPE_ERRORS.inc(courier=currier, error=type(e).__name__)
         logger.error(e)
-        new_data = "ERROR"
+        return "ERROR"
+    # the events are recorded by the next poll, which notifies the other subscribers of the code
+    result_cache.set((currier, cod), events)
+    return data
+
+
+def send_message(bot: telegram.Bot, **kwargs) -> telegram.Message:
+    try:
+        with SEND.time(method='sendMessage'):
+            message = bot.send_message(**kwargs)
+    except Exception as e:
+        SEND_ERRORS.inc(method='sendMessage', error=type(e).__name__)
+        raise
+    MESSAGES_SENT.inc(method='sendMessage')
+    return message
+
+
+def notify_error(job: JobModel, new_data: str):
+    if new_data == "ERROR" and job.last_update != "ERROR":
+        outbox.put(job.chat_id, f"Error happening when trying to get data from {job.courier.upper()} {job.cod}"
+                                f"\nThis would be a invalid code, expired code or courier page error")
+
+
+def notify_update(job: JobModel, new_data: str, notify: bool = True):
+    """Set the job state, messaging the chat if `notify` (False when only the text of the state changed)"""
+    last_update = job.last_update
+    notify_error(job, new_data)
+
+    if new_data != last_update and not notify:
+        registry.set_last_update(job, new_data)
+    elif new_data != last_update:
+        outbox.put(job.chat_id,
+                   f'*UPDATED*: {job.desc} ({job.courier.upper()} {job.cod})\n*FROM*: '
+                   f'{last_update.upper() if last_update is not None else "None"}\n'
+                   f'*TO*: {new_data.upper()}',
+                   parse_mode=telegram.ParseMode.MARKDOWN)
+        registry.set_last_update(job, new_data)
+
+
+def get_data(job: JobModel):
+    new_data = fetch_data(job.courier, job.cod)
+    notify_error(job, new_data)
     return new_data
 
 
-def check_update(context: telegram.ext.CallbackContext):
-    job: Job = context.job
-    data: Dict[str, Any] = job.context
-    job_db: JobModel = JobModel.get(JobModel.chat_id == data["chat_id"], JobModel.name == data["name"])
+def check_update(currier: str, cod: str, result: ScrapeResult):
+    """Fan out the scraped result of a (courier, cod) to every subscribed chat"""
+    key: PollKey = (currier, cod)
+    changed, state = None, None
+    try:
+        if isinstance(result, CircuitOpenError):
+            logger.warning("Skipping %s %s, circuit open", currier, cod)
+            return
+        new_events, known = [], False
+        if isinstance(result, Exception) or len(result) == 0:
+            logger.error(result if isinstance(result, Exception) else f"{currier} {cod} has no tracking events")
+            new_data = "ERROR"
+        else:
+            new_data = dispatcher[currier].summarize(result)
+            new_events, known = event_store.record(key, result)
+        changed, state = len(new_events) > 0, dispatcher[currier].classify(new_data)
+        with CHECK_UPDATE.time(courier=currier):
+            for chat_id, name in scheduler.subscribers(key):
+                job_db: Optional[JobModel] = registry.get(chat_id, name)
+                if job_db is not None:
+                    # new events of a code seen before, or the first state of the job; a different text
+                    # alone (the courier or our formatting changed) silently replaces the state
+                    notify = new_data == "ERROR" or job_db.last_update in (None, "ERROR") or (changed and known)
+                    notify_update(job_db, new_data, notify)
+    finally:
+        scheduler.done(key, changed, state)
+
+
+@db.connection_context()
+def scraped(currier: str, cod: str, result: ScrapeResult):
+    if not isinstance(result, Exception) and len(result) > 0:
+        result_cache.set((currier, cod), result)
+    check_update(currier, cod, result)
+
+
+# noinspection PyUnusedLocal
+@db.connection_context()
+def poll_tick(context: telegram.ext.CallbackContext):
+    due: Dict[str, List[str]] = collections.defaultdict(list)
+    for currier, cod in scheduler.due():
+        cached = result_cache.get((currier, cod))
+        if cached is not None:
+            # scraped moments ago by /force_get, fan out without scraping again
+            check_update(currier, cod, cached)
+        else:
+            due[currier].append(cod)
+    for currier, codes in due.items():
+        engine.submit_many(currier, dispatcher[currier], codes, functools.partial(scraped, currier))
+
 
-    last_update = job_db.last_update
-    currier = job_db.courier
-    cod = job_db.cod
-    desc = job_db.desc
+# noinspection PyUnusedLocal
+@db.connection_context()
+def flush_registry(context: telegram.ext.CallbackContext):
+    written = registry.flush()
+    if written:
+        logger.info("Flushed %d job updates", written)
+    result_cache.flush()
+    event_store.flush()
+    save_poll_states()
 
-    new_data = get_data(job_db, context)
 
-    if new_data != last_update:
-        context.bot.send_message(chat_id=data["chat_id"],
-                                 text=f'*UPDATED*: {desc} ({currier.upper()} {cod})\n*FROM*: '
-                                      f'{last_update.upper() if last_update is not None else "None"}\n'
-                                      f'*TO*: {new_data.upper()}',
-                                 parse_mode=telegram.ParseMode.MARKDOWN
-                                 )
-        job_db.last_update = new_data
-        job_db.save()
+def load_poll_states() -> Dict[PollKey, PollState]:
+    return {(s.courier, s.cod): (s.next_due, s.backoff) for s in PollStateModel.select()}
+
+
+def save_poll_states():
+    """Write the next due time of the keys polled since the last call, so a restart resumes from it"""
+    changes = scheduler.changes()
+    if len(changes) == 0:
+        return
+    try:
+        with db.atomic():
+            # rows of keys no longer polled are kept, another worker may take them over
+            for (courier, cod), (next_due, backoff) in changes.items():
+                (PollStateModel.insert(courier=courier, cod=cod, next_due=next_due, backoff=backoff)
+                 .on_conflict(conflict_target=[PollStateModel.courier, PollStateModel.cod],
+                              update={PollStateModel.next_due: next_due, PollStateModel.backoff: backoff})
+                 .execute())
+    except Exception:
+        with scheduler.lock:
+            scheduler.dirty.update(changes.keys())
+        raise
 
 
 # noinspection PyUnusedLocal
+@db.connection_context()
 def force_get(update: telegram.Update, context: telegram.ext.CallbackContext):
     get_jobs_inline(update)
     return SELECT_JOB
 
 
+@db.connection_context()
 def select_job(update: telegram.Update, context: telegram.ext.CallbackContext):
     key = update.callback_query.data
-    job: JobModel = JobModel.get(JobModel.chat_id == update.effective_message.chat_id, JobModel.name == key)
-    new_data = get_data(job=job, context=context)
+    job: Optional[JobModel] = registry.get(update.effective_message.chat_id, key)
+    if job is None:
+        update.effective_message.edit_text('Subscription not found')
+        return ConversationHandler.END
+    try:
+        new_data = get_data(job=job)
+    except CircuitOpenError:
+        update.effective_message.edit_text(f'{job.courier.upper()} is temporarily unavailable, '
+                                           f'try again in a few minutes')
+        return ConversationHandler.END
     if new_data != job.last_update:
-        job.last_update = new_data
-        job.save()
+        registry.set_last_update(job, new_data)
     update.effective_message.edit_text(f'{job.courier.upper()} {job.cod} has state:\n{new_data}')
     return ConversationHandler.END
 
 
-def main():
-    """Start the bot."""
+def register_gauges():
+    metrics_registry.register(Gauge('courier_bot_subscriptions', 'Subscriptions in the registry',
+                                    function=lambda: {(): sum(len(jobs) for jobs in registry.chats.values())}))
+    metrics_registry.register(Gauge('courier_bot_poll_groups', 'Distinct (courier, cod) polled',
+                                    function=lambda: {(): len(scheduler.groups)}))
+    metrics_registry.register(Gauge('courier_bot_polls_in_flight', 'Polls dispatched and not finished yet',
+                                    function=lambda: {(): sum(g.in_flight for g in list(scheduler.groups.values()))}))
+    metrics_registry.register(Gauge('courier_bot_circuit_open', '1 while the courier circuit breaker is not closed',
+                                    ['courier'], function=lambda: {(c,): int(b.state != "closed")
+                                                                   for c, b in list(guards.breakers.items())}))
+
+
+def create_updater(role: str = "all") -> Updater:
+    """
+    Create the bot with every handler and job registered, without starting it.
+    The "front" role only answers commands, polling is left to the worker processes.
+    """
     # Create the EventHandler and pass it your bot's token.
-    updater = Updater(config["BOT_KEY"], use_context=True)
+    # BOT_API_URL points the bot to another Bot API server, e.g. the fake one of benchmarks.simulate
+    updater = Updater(config["BOT_KEY"], use_context=True, base_url=config.get("BOT_API_URL"),
+                      workers=config.get("DISPATCHER_WORKERS", 4))
     # Get the dispatcher to register handlers
     dp = updater.dispatcher
 
-    for j in JobModel.select():
-        print(j)
-        updater.job_queue.run_repeating(
-            check_update,
-            interval=int(j.delta), first=0,
-            context={"chat_id": j.chat_id, "name": j.name},
-            name=j.name
-        )
+    if role == "front":
+        registry.read_through = True
+        result_cache.read_through = True
+    else:
+        registry.start_loading()
+        threading.Thread(target=recover_jobs, name="recover-jobs", daemon=True).start()
+    engine.start()
+    outbox.start(lambda chat_id, text, parse_mode: send_message(updater.bot, chat_id=chat_id, text=text,
+                                                                parse_mode=parse_mode))
+    if role != "front":
+        # first=0 would already be in the past when the job queue starts and the tick would wait a whole interval
+        updater.job_queue.run_repeating(poll_tick, interval=POLL_TICK, first=1, name="poll_tick")
+        updater.job_queue.run_repeating(flush_registry, interval=FLUSH_INTERVAL, first=FLUSH_INTERVAL,
+                                        name="flush_registry")
 
     # on different commands - answer in Telegram
-    dp.add_handler(CommandHandler("start", start))
-    dp.add_handler(CommandHandler("help", help))
-    dp.add_handler(CommandHandler("subscriptions", get_subscriptions))
+    dp.add_handler(CommandHandler("start", start, run_async=True))
+    dp.add_handler(CommandHandler("help", help, run_async=True))
+    dp.add_handler(CommandHandler("subscriptions", get_subscriptions, run_async=True))
+    dp.add_handler(CommandHandler("export", export_subscriptions, run_async=True))
+    # probing the couriers of a few hundred codes takes a while, keep it off the dispatcher thread
+    dp.add_handler(CommandHandler("bulk_subscribe", bulk_subscribe, run_async=True))
+    dp.add_handler(MessageHandler(Filters.document & Filters.caption_regex(r'^/bulk_subscribe\b'), bulk_subscribe,
+                                  run_async=True))
     shut_up_hand = ConversationHandler(
         entry_points=[CommandHandler('shut_up', shut_up)],
 
@@ -356,14 +756,223 @@ def main():
     dp.add_handler(force_get_hand)
     # log all errors
     dp.add_error_handler(error)
+    return updater
+
+
+def retry(fn: Callable, what: str):
+    """Call `fn` until it succeeds, for the startup steps the bot can't poll without"""
+    failures = 0
+    while True:
+        try:
+            return fn()
+        except Exception as e:
+            failures += 1
+            logger.error("%s failed, retrying: %s", what, e)
+            timer.sleep(min(2 ** failures, 60))
+
+
+def recover_jobs(chunk_size: int = RECOVERY_CHUNK):
+    """
+    Load the jobs after startup, while the bot already answers, `chunk_size` at a time in id order so a
+    failed query is retried from where it stopped. Terminal jobs and jobs of removed couriers are loaded
+    but not polled.
+    """
+    start = timer.monotonic()
+    retry(result_cache.load, "Loading cached results")
+    retry(event_store.load, "Loading events")
+    saved = retry(load_poll_states, "Loading poll states")
+    total = retry(JobModel.select().count, "Counting jobs")
+    last_id, loaded, polled = None, 0, 0
+    disabled = collections.Counter()
+    while True:
+        query = JobModel.select().order_by(JobModel.id).limit(chunk_size)
+        if last_id is not None:
+            query = query.where(JobModel.id > last_id)
+        chunk = retry(lambda: list(query), f"Loading jobs after {last_id}")
+        if len(chunk) == 0:
+            break
+        last_id = chunk[-1].id
+
+        jobs = registry.load(chunk)
+        disabled.update(j.courier for j in jobs if j.courier not in dispatcher)
+        subscriptions = [subscription(j) for j in jobs if pollable(j)]
+        scheduler.resume(subscriptions, saved, spread=STARTUP_SPREAD)
+        loaded += len(jobs)
+        polled += len(subscriptions)
+        JOBS_RECOVERED.set(polled, polled="true")
+        JOBS_RECOVERED.set(loaded - polled, polled="false")
+        logger.info("Recovered %d/%d jobs (%d polled)", loaded, total, polled)
+
+    registry.finish_loading()
+    RECOVERY_DONE.set(1)
+    if disabled:
+        logger.warning("Not polling the jobs of disabled couriers: %s", dict(disabled))
+    logger.info("Recovered %d jobs in %.1fs", loaded, timer.monotonic() - start)
+    # give the connection of this thread back to the pool
+    db.close()
+
+
+def pollable(job: JobModel) -> bool:
+    """False for terminal jobs and jobs of couriers removed from the config"""
+    return job.courier in dispatcher and dispatcher[job.courier].classify(job.last_update) != TERMINAL
+
+
+def subscription(job: JobModel) -> Tuple[PollKey, Subscriber, int, bool]:
+    return ((job.courier, job.cod), (job.chat_id, job.name), int(job.delta),
+            dispatcher[job.courier].classify(job.last_update) == TERMINAL)
+
+
+@db.connection_context()
+def sync_shards(coordinator: ShardCoordinator, synced: Set[int],
+                since: Optional[float]) -> Tuple[Set[int], float]:
+    """
+    Renew the shard leases and make the registry and scheduler poll the jobs of the owned shards. The jobs
+    of shards not `synced` before are loaded whole, for the others only the jobs created or removed after
+    `since` (the previous sync) are read. Returns the `synced` shards and `since` of the next sync.
+    """
+    started = timer.time()
+    owned = coordinator.heartbeat()
+    lost, gained = synced - owned, owned - synced
+    shard = shard_sql(JobModel.key_hash, coordinator.shards)
+
+    removed = []
+    if lost:
+        registry.flush()
+        _, removed = registry.sync([j for j in registry.jobs()
+                                    if shard_of((j.courier, j.cod), coordinator.shards) in owned])
+    taken, created = [], []
+    if gained:
+        taken = registry.load(JobModel.select().where(shard.in_(list(gained))))
+    if since is not None and owned - gained:
+        # rows committed a bit late or by a process with a skewed clock
+        after = since - LEASE_TTL
+        kept = list(owned - gained)
+        created = registry.load(JobModel.select().where(shard.in_(kept) & (JobModel.created_at > after)))
+        removals = (JobRemovalModel.select()
+                    .where((JobRemovalModel.removed_at > after) &
+                           shard_sql(JobRemovalModel.key_hash, coordinator.shards).in_(kept)))
+        for removal in removals:
+            job = registry.get(removal.chat_id, removal.name)
+            if job is not None and job.id == removal.job_id:
+                registry.remove(removal.chat_id, removal.name)
+                removed.append(job)
+        JobRemovalModel.delete().where(JobRemovalModel.removed_at < started - REMOVAL_RETENTION).execute()
+
+    for j in removed:
+        scheduler.unsubscribe((j.courier, j.cod), (j.chat_id, j.name))
+    if gained:
+        # keys of shards just taken over resume from where their previous worker left them
+        event_store.load()
+        scheduler.resume([subscription(j) for j in taken if pollable(j)], load_poll_states(),
+                         spread=STARTUP_SPREAD)
+    # new jobs are polled right away like in a single process, spaced like a bulk subscription. The
+    # created_at window reads jobs again on the next syncs, those are already subscribed
+    fresh = [s for s in (subscription(j) for j in created if pollable(j))
+             if s[1] not in scheduler.subscribers(s[0])]
+    spacing = BULK_SPREAD / max(1, len(fresh))
+    for i, (key, subscriber, delta, terminal) in enumerate(fresh):
+        scheduler.subscribe(key, subscriber, delta, first=i * spacing, terminal=terminal)
+    if lost or gained or removed or fresh:
+        logger.info("Shard sync: %d shards taken over, %d released, %d jobs read, %d new, %d removed",
+                    len(gained), len(lost), len(taken), len(fresh), len(removed))
+    return owned, started
+
+
+def run_worker():
+    """Poll the jobs of the shards leased by this process until SIGINT or SIGTERM, without taking updates"""
+    bot = telegram.Bot(config["BOT_KEY"], base_url=config.get("BOT_API_URL"))
+    coordinator = ShardCoordinator(f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}",
+                                   shards=SHARDS, ttl=LEASE_TTL)
+    stop = threading.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(sig, lambda signum, frame: stop.set())
+
+    result_cache.load()
+    event_store.load()
+    engine.start()
+    outbox.start(lambda chat_id, text, parse_mode: send_message(bot, chat_id=chat_id, text=text,
+                                                                parse_mode=parse_mode))
+    next_sync = next_flush = 0.0
+    synced, synced_at = set(), None
+    try:
+        while not stop.is_set():
+            now = timer.monotonic()
+            if now >= next_sync:
+                try:
+                    synced, synced_at = sync_shards(coordinator, synced, synced_at)
+                except Exception as e:
+                    # keep polling the shards already owned, their leases stay valid until LEASE_TTL
+                    logger.error("Shard sync failed: %s", e)
+                next_sync = now + HEARTBEAT_INTERVAL
+            if now >= next_flush:
+                try:
+                    flush_registry(None)
+                except Exception as e:
+                    # the pending writes stay in the registry for the next flush
+                    logger.error("Registry flush failed: %s", e)
+                next_flush = now + FLUSH_INTERVAL
+            try:
+                poll_tick(None)
+            except Exception as e:
+                logger.error("Poll tick failed: %s", e)
+            stop.wait(POLL_TICK)
+    finally:
+        shutdown()
+        coordinator.release()
+
+
+def main():
+    """Start the bot."""
+    parser = argparse.ArgumentParser(description="Chile Courier Bot")
+    parser.add_argument("--role", choices=["all", "front", "worker"], default=config.get("ROLE", "all"),
+                        help="all: a single process, front: telegram updates only, worker: shard of the polling")
+    args = parser.parse_args()
+
+    if config.get("METRICS_PORT"):
+        register_gauges()
+        serve_metrics(config["METRICS_PORT"], config.get("METRICS_HOST", "127.0.0.1"))
+
+    if args.role == "worker":
+        run_worker()
+        return
+
+    updater = create_updater(args.role)
 
     # Start the Bot
-    updater.start_polling()
+    webhook = config.get("WEBHOOK")
+    if webhook:
+        # PTB serves the webhook from a tornado (asyncio) server, updates are handled by the dispatcher workers
+        updater.start_webhook(listen=webhook.get("listen", "0.0.0.0"),
+                              port=webhook.get("port", 8443),
+                              url_path=webhook.get("url_path", ""),
+                              webhook_url=webhook["url"],
+                              cert=webhook.get("cert"),
+                              key=webhook.get("key"),
+                              max_connections=webhook.get("max_connections", 40))
+    else:
+        updater.start_polling()
 
     # Run the bot until you press Ctrl-C or the process receives SIGINT,
     # SIGTERM or SIGABRT. This should be used most of the time, since
     # start_polling() is non-blocking and will stop the bot gracefully.
     updater.idle()
+    shutdown()
+
+
+def shutdown(timeout: float = SHUTDOWN_TIMEOUT):
+    """
+    Drain after the updater stopped taking updates and running jobs: wait for in-flight scrapes
+    and their fan out, send the queued notifications, then write the pending job updates.
+    """
+    logger.info("Shutting down, draining in-flight polls")
+    engine.stop(timeout=timeout)
+    outbox.stop(timeout=timeout)
+    registry.flush()
+    result_cache.flush()
+    event_store.flush()
+    save_poll_states()
+    db.close()
+    logger.info("Shutdown complete")
 
 
 if __name__ == '__main__':
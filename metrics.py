@@ -0,0 +1,180 @@
+"""
+Small in-process metrics in the Prometheus text format, served on a local http endpoint.
+"""
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+LabelValues = Tuple[str, ...]
+
+DEFAULT_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60)
+
+
+def _labels(names: Sequence[str], values: LabelValues, extra: str = '') -> str:
+    pairs = ['%s="%s"' % (n, v.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+             for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Metric:
+    type = ''
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+        self.lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, str]) -> LabelValues:
+        return tuple(str(labels.get(n, '')) for n in self.label_names)
+
+    def samples(self) -> List[str]:
+        raise NotImplementedError()
+
+    def render(self) -> str:
+        return '\n'.join([f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type}',
+                          *self.samples()])
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = ()):
+        super().__init__(name, documentation, labels)
+        self.values: Dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self) -> List[str]:
+        with self.lock:
+            return [f'{self.name}{_labels(self.label_names, k)} {v}' for k, v in self.values.items()]
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = (),
+                 function: Optional[Callable[[], Dict[LabelValues, float]]] = None):
+        super().__init__(name, documentation, labels)
+        self.values: Dict[LabelValues, float] = {}
+        # values computed at scrape time instead of set by the code
+        self.function = function
+
+    def set(self, value: float, **labels):
+        with self.lock:
+            self.values[self._key(labels)] = value
+
+    def samples(self) -> List[str]:
+        with self.lock:
+            values = dict(self.values)
+        if self.function is not None:
+            values.update(self.function())
+        return [f'{self.name}{_labels(self.label_names, k)} {v}' for k, v in values.items()]
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(buckets)
+        self.counts: Dict[LabelValues, List[int]] = {}
+        self.sums: Dict[LabelValues, float] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self.lock:
+            counts = self.counts.setdefault(key, [0] * (len(self.buckets) + 1))
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self.sums[key] = self.sums.get(key, 0) + value
+
+    @contextmanager
+    def time(self, **labels) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self) -> List[str]:
+        lines = []
+        with self.lock:
+            for key, counts in self.counts.items():
+                cumulative = 0
+                for bound, count in zip([*self.buckets, '+Inf'], counts):
+                    cumulative += count
+                    le = 'le="%s"' % bound
+                    lines.append(f'{self.name}_bucket{_labels(self.label_names, key, le)} {cumulative}')
+                lines.append(f'{self.name}_sum{_labels(self.label_names, key)} {self.sums[key]}')
+                lines.append(f'{self.name}_count{_labels(self.label_names, key)} {cumulative}')
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: Dict[str, Metric] = {}
+
+    def register(self, metric: Metric) -> Metric:
+        self.metrics[metric.name] = metric
+        return metric
+
+    def render(self) -> str:
+        return '\n'.join(m.render() for m in self.metrics.values()) + '\n'
+
+
+registry = Registry()
+
+POLL_LAG = registry.register(Histogram(
+    'courier_bot_poll_lag_seconds', 'Seconds between a (courier, cod) being due and its poll being dispatched',
+    buckets=(.1, .5, 1, 2.5, 5, 10, 30, 60, 120, 300)))
+CHECK_UPDATE = registry.register(Histogram(
+    'courier_bot_check_update_seconds', 'Fan out of a scraped result to its subscribers', ['courier']))
+SCRAPE = registry.register(Histogram(
+    'courier_bot_scrape_seconds', 'Courier fetch and parse latency, per request', ['courier']))
+SCRAPE_ERRORS = registry.register(Counter(
+    'courier_bot_scrape_errors_total', 'Failed scrapes by courier and exception', ['courier', 'error']))
+DB_QUERY = registry.register(Histogram(
+    'courier_bot_db_query_seconds', 'SQLite query latency by statement type', ['statement']))
+MESSAGES_SENT = registry.register(Counter(
+    'courier_bot_messages_sent_total', 'Messages sent to telegram', ['method']))
+SEND = registry.register(Histogram(
+    'courier_bot_send_seconds', 'Telegram send latency', ['method']))
+SEND_ERRORS = registry.register(Counter(
+    'courier_bot_send_errors_total', 'Failed telegram sends by exception', ['method', 'error']))
+JOBS_RECOVERED = registry.register(Gauge(
+    'courier_bot_jobs_recovered', 'Jobs loaded from the database since startup, by whether they are polled',
+    ['polled']))
+RECOVERY_DONE = registry.register(Gauge(
+    'courier_bot_recovery_done', '1 once every job in the database was loaded at startup'))
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        payload = registry.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+
+def serve(port: int, host: str = '127.0.0.1') -> ThreadingHTTPServer:
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    return server
@@ -1,10 +1,20 @@
-from playhouse.migrate import *
+from peewee import *
+from playhouse.migrate import migrate
 
-db = SqliteDatabase('database.db')
-migrator = SqliteMigrator(db)
 
-desc = CharField(null=True, default=None)
+class JobModel(Model):
+    """The jobs table as first released"""
+    id = CharField(unique=True)
+    name = CharField()
+    chat_id = CharField()
+    delta = CharField()
+    courier = CharField()
+    cod = CharField()
+    last_update = CharField(null=True)
 
-migrate(
-    migrator.add_column('jobmodel', 'desc', desc),
-)
+
+def up(db, migrator):
+    with db.bind_ctx([JobModel]):
+        db.create_tables([JobModel])
+    if 'desc' not in {column.name for column in db.get_columns('jobmodel')}:
+        migrate(migrator.add_column('jobmodel', 'desc', CharField(null=True, default=None)))
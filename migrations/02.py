@@ -0,0 +1,10 @@
+from playhouse.migrate import migrate
+
+# journal_mode=wal is now set on every connection by models.connect
+
+
+def up(db, migrator):
+    indexes = {tuple(index.columns) for index in db.get_indexes('jobmodel')}
+    migrate(*[migrator.add_index('jobmodel', columns, unique)
+              for columns, unique in ((('chat_id', 'name'), True), (('courier', 'cod'), False))
+              if columns not in indexes])
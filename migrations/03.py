@@ -0,0 +1,17 @@
+from peewee import *
+
+
+class WorkerModel(Model):
+    id = CharField(primary_key=True)
+    heartbeat = DoubleField()
+
+
+class ShardLease(Model):
+    shard = IntegerField(primary_key=True)
+    worker_id = CharField()
+    expires_at = DoubleField()
+
+
+def up(db, migrator):
+    with db.bind_ctx([WorkerModel, ShardLease]):
+        db.create_tables([WorkerModel, ShardLease])
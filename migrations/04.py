@@ -0,0 +1,16 @@
+from peewee import *
+
+
+class ScrapeResultModel(Model):
+    courier = CharField()
+    cod = CharField()
+    data = TextField()
+    fetched_at = DoubleField()
+
+    class Meta:
+        primary_key = CompositeKey('courier', 'cod')
+
+
+def up(db, migrator):
+    with db.bind_ctx([ScrapeResultModel]):
+        db.create_tables([ScrapeResultModel])
@@ -0,0 +1,16 @@
+from peewee import *
+
+
+class PollStateModel(Model):
+    courier = CharField()
+    cod = CharField()
+    next_due = DoubleField()
+    backoff = IntegerField(default=1)
+
+    class Meta:
+        primary_key = CompositeKey('courier', 'cod')
+
+
+def up(db, migrator):
+    with db.bind_ctx([PollStateModel]):
+        db.create_tables([PollStateModel])
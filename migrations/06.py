@@ -0,0 +1,21 @@
+from peewee import *
+
+
+class EventModel(Model):
+    courier = CharField()
+    cod = CharField()
+    event_ts = CharField()
+    status = CharField()
+    location = CharField(default='')
+    seen_at = DoubleField()
+
+    class Meta:
+        indexes = (
+            (('courier', 'cod', 'event_ts'), False),
+            (('courier', 'cod', 'event_ts', 'status', 'location'), True),
+        )
+
+
+def up(db, migrator):
+    with db.bind_ctx([EventModel]):
+        db.create_tables([EventModel])
@@ -0,0 +1,22 @@
+from peewee import *
+from playhouse.migrate import migrate
+
+
+class EventModel(Model):
+    courier = CharField()
+    cod = CharField()
+    event_ts = CharField()
+    status = CharField()
+    location = CharField(default='')
+
+
+EventModel.add_index(EventModel.index(EventModel.courier, EventModel.cod, EventModel.event_ts, EventModel.status,
+                                      EventModel.location, unique=True, where=(EventModel.event_ts != '')))
+
+
+def up(db, migrator):
+    # events without a time are only unique per status change, not per (status, location)
+    if 'eventmodel_courier_cod_event_ts_status_location' in {index.name for index in db.get_indexes('eventmodel')}:
+        migrate(migrator.drop_index('eventmodel', 'eventmodel_courier_cod_event_ts_status_location'))
+    with db.bind_ctx([EventModel]):
+        EventModel._schema.create_indexes()
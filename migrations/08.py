@@ -0,0 +1,42 @@
+import hashlib
+
+from peewee import *
+from playhouse.migrate import migrate
+
+
+class JobModel(Model):
+    id = CharField(unique=True)
+    courier = CharField()
+    cod = CharField()
+    key_hash = IntegerField(null=True)
+
+
+class JobRemovalModel(Model):
+    job_id = CharField(primary_key=True)
+    chat_id = CharField()
+    name = CharField()
+    key_hash = IntegerField()
+    removed_at = DoubleField(index=True)
+
+
+def key_hash(courier: str, cod: str) -> int:
+    # sharding.key_hash when this migration was written
+    return int(hashlib.md5(f"{courier}\0{cod}".encode()).hexdigest()[:16], 16) & 0x7fffffff
+
+
+def up(db, migrator):
+    columns = {column.name for column in db.get_columns('jobmodel')}
+    if 'key_hash' not in columns:
+        migrate(migrator.add_column('jobmodel', 'key_hash', IntegerField(null=True)))
+    if 'created_at' not in columns:
+        # jobs created before are loaded with the whole shard, only later ones are synced by creation time
+        migrate(migrator.add_column('jobmodel', 'created_at', DoubleField(null=True)),
+                migrator.add_index('jobmodel', ('created_at',), False))
+    with db.bind_ctx([JobModel, JobRemovalModel]):
+        db.create_tables([JobRemovalModel])
+        keys = list(JobModel.select(JobModel.courier, JobModel.cod).where(JobModel.key_hash.is_null())
+                    .distinct().tuples())
+        for courier, cod in keys:
+            (JobModel.update(key_hash=key_hash(courier, cod))
+             .where((JobModel.courier == courier) & (JobModel.cod == cod))
+             .execute())
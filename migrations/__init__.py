@@ -0,0 +1,49 @@
+"""
+Schema migrations. Every numbered module defines `up(db, migrator)`, they are applied in order and
+recorded in the migrationmodel table, so each runs once per database:
+
+    python -m migrations [--database URL]
+
+Migrations check the schema before changing it, databases migrated by running the old scripts by hand
+are recorded without changes.
+"""
+import importlib
+import logging
+import pkgutil
+import time
+from typing import List
+
+from peewee import CharField, Database, DatabaseProxy, DoubleField, Model
+from playhouse.migrate import SchemaMigrator
+
+logger = logging.getLogger(__name__)
+
+
+class MigrationModel(Model):
+    name = CharField(primary_key=True)
+    applied_at = DoubleField()
+
+
+def available() -> List[str]:
+    return sorted(module.name for module in pkgutil.iter_modules(__path__) if module.name.isdigit())
+
+
+def run(database: Database) -> List[str]:
+    """Apply the pending migrations, each in its own transaction, returns their names"""
+    if isinstance(database, DatabaseProxy):
+        database = database.obj
+    migrator = SchemaMigrator.from_database(database)
+    applied = []
+    with database.bind_ctx([MigrationModel]):
+        database.create_tables([MigrationModel])
+        done = {migration.name for migration in MigrationModel.select(MigrationModel.name)}
+        for name in available():
+            if name in done:
+                continue
+            module = importlib.import_module(f"{__name__}.{name}")
+            with database.atomic():
+                module.up(database, migrator)
+                MigrationModel.create(name=name, applied_at=time.time())
+            logger.info("Applied migration %s", name)
+            applied.append(name)
+    return applied
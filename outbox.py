@@ -0,0 +1,189 @@
+import logging
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import telegram.error
+
+from limits import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+OutboxKey = Tuple[str, Optional[str]]  # (chat_id, parse_mode)
+Sender = Callable[[str, str, Optional[str]], Any]  # (chat_id, text, parse_mode)
+
+TELEGRAM_MESSAGE_LIMIT = 4096
+
+
+def pack(texts: List[str], limit: int = TELEGRAM_MESSAGE_LIMIT) -> List[List[str]]:
+    """Group messages into as few digests as fit in a telegram message, never splitting a message"""
+    digests: List[List[str]] = []
+    size = 0
+    for text in texts:
+        if digests and size + 2 + len(text) <= limit:
+            digests[-1].append(text)
+            size += 2 + len(text)
+        else:
+            digests.append([text])
+            size = len(text)
+    return digests
+
+
+class Outbox:
+    """
+    Sends poll notifications off the polling threads. Messages for the same chat queued within
+    `window` seconds are coalesced into one digest, sends are rate limited per chat and globally,
+    and flood limits (RetryAfter) or network errors are retried later with backoff.
+    """
+
+    def __init__(self, global_rate: float = 25, chat_rate: float = 1, window: float = 2, workers: int = 4,
+                 max_retries: int = 5):
+        self.global_bucket = TokenBucket(global_rate, max(1, int(global_rate)))
+        self.chat_rate = chat_rate
+        self.window = window
+        self.workers = workers
+        self.max_retries = max_retries
+        self.send: Optional[Sender] = None
+
+        self.pending: Dict[OutboxKey, List[str]] = {}
+        self.first_at: Dict[OutboxKey, float] = {}
+        self.not_before: Dict[OutboxKey, float] = {}
+        self.attempts: Dict[OutboxKey, int] = {}
+        # how many of the first pending messages must be sent one at a time, after their digest was rejected
+        self.single: Dict[OutboxKey, int] = {}
+        self.chat_buckets: Dict[str, TokenBucket] = {}
+        self.sending: set = set()
+        self.cond = threading.Condition()
+        self.draining = False
+        self.stopped = False
+        self.threads: List[threading.Thread] = []
+
+    def start(self, send: Sender):
+        self.send = send
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._run, name=f"outbox-{i}", daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def put(self, chat_id, text: str, parse_mode: Optional[str] = None):
+        key = (str(chat_id), parse_mode)
+        with self.cond:
+            if key not in self.pending:
+                self.pending[key] = []
+                self.first_at[key] = time.monotonic()
+            self.pending[key].append(text)
+            self.cond.notify()
+
+    def __len__(self):
+        with self.cond:
+            return sum(len(texts) for texts in self.pending.values()) + len(self.sending)
+
+    def stop(self, drain: bool = True, timeout: float = 30):
+        """Stop the workers, sending what is queued first (ignoring the coalesce window) if `drain`"""
+        deadline = time.monotonic() + timeout
+        with self.cond:
+            self.draining = True
+            self.cond.notify_all()
+            while drain and (self.pending or self.sending) and time.monotonic() < deadline:
+                self.cond.wait(0.1)
+            self.stopped = True
+            self.cond.notify_all()
+        for thread in self.threads:
+            thread.join(max(0.0, deadline - time.monotonic()))
+        if self.pending:
+            logger.warning("Outbox stopped with %d chats pending", len(self.pending))
+
+    def _chat_bucket(self, chat_id: str) -> TokenBucket:
+        if chat_id not in self.chat_buckets:
+            self.chat_buckets[chat_id] = TokenBucket(self.chat_rate, 1)
+        return self.chat_buckets[chat_id]
+
+    def _next(self) -> Tuple[Optional[OutboxKey], float]:
+        """Pop the next chat ready to be sent, or how long to wait for one. Called holding the lock."""
+        now = time.monotonic()
+        wait = 1.0
+        for key in self.pending:
+            if key in self.sending:
+                continue
+            ready_at = max(self.not_before.get(key, 0), now if self.draining else self.first_at[key] + self.window)
+            if ready_at > now:
+                wait = min(wait, ready_at - now)
+                continue
+            if not self.global_bucket.try_acquire():
+                return None, min(wait, 1 / self.global_bucket.rate)
+            if not self._chat_bucket(key[0]).try_acquire():
+                self.global_bucket.refund()
+                wait = min(wait, 1 / self.chat_rate)
+                continue
+            self.sending.add(key)
+            return key, 0
+        return None, wait
+
+    def _send_next(self, chat_id: str, texts: List[str], parse_mode: Optional[str], single: int) -> Tuple[int, int]:
+        """
+        Send the first digest of `texts`, or only the first message while the first `single` ones must go
+        one at a time. Returns how many messages were sent or dropped and how many must still go one at a
+        time. When telegram rejects a digest (e.g. broken markdown in a description) its messages are sent
+        one at a time in the next turns, so only the bad one is lost.
+        """
+        digest = texts[:1] if single > 0 else pack(texts)[0]
+        try:
+            self.send(chat_id, "\n\n".join(digest), parse_mode)
+        except telegram.error.BadRequest as e:
+            if len(digest) > 1:
+                logger.warning("Digest of %d messages to %s rejected, sending them one at a time: %s",
+                               len(digest), chat_id, e)
+                return 0, len(digest)
+            logger.error("Dropping a message to %s: %s", chat_id, e)
+        return len(digest), max(0, single - len(digest))
+
+    def _run(self):
+        while True:
+            with self.cond:
+                key, wait = self._next()
+                while key is None:
+                    if self.stopped:
+                        return
+                    self.cond.wait(wait)
+                    key, wait = self._next()
+                texts = self.pending.pop(key)
+                del self.first_at[key]
+                self.not_before.pop(key, None)
+                single = self.single.pop(key, 0)
+
+            chat_id, parse_mode = key
+            done, retry_in = 0, None
+            try:
+                # one message per turn, the rest waits for the chat bucket again
+                done, single = self._send_next(chat_id, texts, parse_mode, single)
+            except telegram.error.RetryAfter as e:
+                retry_in = float(e.retry_after)
+            except telegram.error.Unauthorized as e:
+                logger.error("Dropping %d messages to %s: %s", len(texts), chat_id, e)
+                done = len(texts)
+            except (telegram.error.TimedOut, telegram.error.NetworkError) as e:
+                retry_in = 2.0 ** self.attempts.get(key, 0)
+                logger.warning("Send to %s failed, retrying in %.0fs: %s", chat_id, retry_in, e)
+            except Exception as e:
+                logger.error("Dropping %d messages to %s: %s", len(texts), chat_id, e)
+                done = len(texts)
+
+            with self.cond:
+                self.sending.discard(key)
+                unsent = texts[done:]
+                if retry_in is None:
+                    self.attempts.pop(key, None)
+                elif self.attempts.get(key, 0) < self.max_retries:
+                    self.attempts[key] = self.attempts.get(key, 0) + 1
+                    self.not_before[key] = time.monotonic() + retry_in
+                else:
+                    logger.error("Dropping messages to %s after %d retries", chat_id, self.max_retries)
+                    self.attempts.pop(key, None)
+                    unsent = []
+                if unsent:
+                    # unsent messages go back in front of anything queued meanwhile, already past the window
+                    self.pending[key] = unsent + self.pending.get(key, [])
+                    self.first_at[key] = time.monotonic() - self.window
+                    if single > 0:
+                        self.single[key] = single
+                self.cond.notify_all()
@@ -0,0 +1,137 @@
+import threading
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from models import JobModel, db
+
+
+class JobRegistry:
+    """
+    In-memory copy of every JobModel row, the source of truth while the bot runs.
+    Inserts and deletes go straight to the database, `last_update` changes are written
+    behind in a single transaction by `flush`.
+
+    With `read_through` (the front process of a sharded deployment, where pollers in other
+    processes own `last_update`) nothing is kept in memory and every call goes to the database.
+    While `loading` (jobs are loaded in chunks after startup) lookups missing in memory fall back
+    to the database, and jobs removed meanwhile are not loaded anymore.
+    """
+
+    def __init__(self, read_through: bool = False):
+        self.read_through = read_through
+        self.loading = False
+        self.chats: Dict[str, Dict[str, JobModel]] = {}  # chat_id -> name -> job
+        self.pending: Dict[str, Optional[str]] = {}  # JobModel.id -> last_update
+        self.removed: Set[str] = set()  # JobModel.id removed while loading
+        self.lock = threading.Lock()
+
+    def load(self, jobs: Iterable[JobModel]) -> List[JobModel]:
+        loaded = []
+        with self.lock:
+            for job in jobs:
+                if job.id in self.removed:
+                    continue
+                # keep the instance of a job added while loading, it may have updates pending
+                job = self.chats.setdefault(str(job.chat_id), {}).setdefault(job.name, job)
+                loaded.append(job)
+        return loaded
+
+    def start_loading(self):
+        with self.lock:
+            self.loading = True
+
+    def finish_loading(self):
+        with self.lock:
+            self.loading = False
+            self.removed = set()
+
+    def sync(self, jobs: Iterable[JobModel]) -> Tuple[List[JobModel], List[JobModel]]:
+        """
+        Make the registry hold exactly `jobs`, keeping the in-memory copy of jobs already known.
+        Returns the (added, removed) jobs. Pending updates should be flushed before.
+        """
+        fresh = {(str(job.chat_id), job.name): job for job in jobs}
+        with self.lock:
+            current = {(chat_id, name): job for chat_id, chat_jobs in self.chats.items()
+                       for name, job in chat_jobs.items()}
+            added = [job for key, job in fresh.items() if key not in current]
+            removed = [job for key, job in current.items() if key not in fresh]
+            for job in added:
+                self.chats.setdefault(str(job.chat_id), {})[job.name] = job
+            for job in removed:
+                jobs_of_chat = self.chats[str(job.chat_id)]
+                del jobs_of_chat[job.name]
+                if len(jobs_of_chat) == 0:
+                    del self.chats[str(job.chat_id)]
+                self.pending.pop(job.id, None)
+        return added, removed
+
+    def get(self, chat_id, name: str) -> Optional[JobModel]:
+        if self.read_through:
+            return JobModel.get_or_none(JobModel.chat_id == str(chat_id), JobModel.name == name)
+        with self.lock:
+            job = self.chats.get(str(chat_id), {}).get(name)
+            if job is not None or not self.loading:
+                return job
+        job = JobModel.get_or_none(JobModel.chat_id == str(chat_id), JobModel.name == name)
+        if job is None:
+            return None
+        # the loader and later lookups share this instance
+        loaded = self.load([job])
+        return loaded[0] if loaded else None
+
+    def for_chat(self, chat_id) -> List[JobModel]:
+        if self.read_through:
+            return list(JobModel.select().where(JobModel.chat_id == str(chat_id)))
+        with self.lock:
+            if not self.loading:
+                return list(self.chats.get(str(chat_id), {}).values())
+        return self.load(JobModel.select().where(JobModel.chat_id == str(chat_id)))
+
+    def jobs(self) -> List[JobModel]:
+        with self.lock:
+            return [job for chat_jobs in self.chats.values() for job in chat_jobs.values()]
+
+    def add(self, job: JobModel):
+        if self.read_through:
+            return
+        with self.lock:
+            self.chats.setdefault(str(job.chat_id), {})[job.name] = job
+
+    def remove(self, chat_id, name: str) -> Optional[JobModel]:
+        with self.lock:
+            jobs = self.chats.get(str(chat_id), {})
+            job = jobs.pop(name, None)
+            if len(jobs) == 0:
+                self.chats.pop(str(chat_id), None)
+            if job is not None:
+                self.pending.pop(job.id, None)
+                if self.loading:
+                    self.removed.add(job.id)
+            return job
+
+    def set_last_update(self, job: JobModel, last_update: Optional[str]):
+        if self.read_through:
+            job.last_update = last_update
+            JobModel.update(last_update=last_update).where(JobModel.id == job.id).execute()
+            return
+        with self.lock:
+            job.last_update = last_update
+            if job.name in self.chats.get(str(job.chat_id), {}):
+                self.pending[job.id] = last_update
+
+    def flush(self) -> int:
+        """Write every pending `last_update` in one transaction, returns the number of rows written"""
+        with self.lock:
+            pending, self.pending = self.pending, {}
+        if len(pending) == 0:
+            return 0
+        try:
+            with db.atomic():
+                for job_id, last_update in pending.items():
+                    JobModel.update(last_update=last_update).where(JobModel.id == job_id).execute()
+        except Exception:
+            with self.lock:
+                # keep newer values set while flushing
+                self.pending = {**pending, **self.pending}
+            raise
+        return len(pending)
@@ -0,0 +1,161 @@
+import random
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Callable, Dict, Iterable, List, Mapping, Optional, Set, Tuple
+
+from classes import DELIVERING, TERMINAL
+
+PollKey = Tuple[str, str]  # (courier, cod)
+Subscriber = Tuple[str, str]  # (chat_id, name)
+PollState = Tuple[float, int]  # (next_due, backoff)
+
+
+@dataclass
+class PollGroup:
+    subscribers: Dict[Subscriber, int] = field(default_factory=dict)
+    next_due: float = 0.0
+    last_run: float = 0.0
+    in_flight: bool = False
+    backoff: int = 1
+    terminal: bool = False
+
+    @property
+    def interval(self) -> int:
+        return min(self.subscribers.values())
+
+
+class PollScheduler:
+    """
+    Groups subscriptions by (courier, cod) so every tracking code is fetched once per interval,
+    using the shortest delta among its subscribers, no matter how many chats listen to it.
+
+    In adaptive mode the interval doubles every poll without changes (up to `max_backoff` times the
+    delta), goes back to the delta on changes or while the parcel is out for delivery, and polling
+    stops once the shipment reaches a terminal state.
+    """
+
+    def __init__(self, adaptive: bool = False, max_backoff: int = 32,
+                 on_dispatch: Optional[Callable[[PollKey, float], None]] = None):
+        self.adaptive = adaptive
+        self.max_backoff = max_backoff
+        # called with every dispatched key and its lag, the seconds between its due time and the dispatch
+        self.on_dispatch = on_dispatch
+        self.groups: Dict[PollKey, PollGroup] = {}
+        # keys whose next due time changed since the last `changes`
+        self.dirty: Set[PollKey] = set()
+        self.lock = threading.Lock()
+
+    def subscribe(self, key: PollKey, subscriber: Subscriber, delta: int, first: float = 0, terminal: bool = False):
+        with self.lock:
+            self._subscribe(key, subscriber, delta, first, terminal)
+
+    def _subscribe(self, key: PollKey, subscriber: Subscriber, delta: int, first: float, terminal: bool):
+        group = self.groups.get(key)
+        if group is None:
+            group = self.groups[key] = PollGroup(next_due=time.time() + first, terminal=self.adaptive and terminal)
+        else:
+            group.terminal = group.terminal and self.adaptive and terminal
+        group.subscribers[subscriber] = int(delta)
+        group.next_due = min(group.next_due, time.time() + first)
+
+    def resume(self, subscriptions: Iterable[Tuple[PollKey, Subscriber, int, bool]],
+               saved: Mapping[PollKey, PollState], spread: Optional[float] = None):
+        """
+        Subscribe (key, subscriber, delta, terminal) tuples of jobs loaded from the database and `stagger`
+        the keys new to the scheduler in the same step, so no poll sees them before their first due time
+        is spread. Keys already polled keep their due time.
+        """
+        with self.lock:
+            new_keys = []
+            for key, subscriber, delta, terminal in subscriptions:
+                if key not in self.groups:
+                    new_keys.append(key)
+                self._subscribe(key, subscriber, delta, float('inf'), terminal)
+            self._stagger(saved, new_keys, spread)
+
+    def unsubscribe(self, key: PollKey, subscriber: Subscriber) -> bool:
+        with self.lock:
+            group = self.groups.get(key)
+            if group is None or subscriber not in group.subscribers:
+                return False
+            del group.subscribers[subscriber]
+            if len(group.subscribers) == 0:
+                del self.groups[key]
+            return True
+
+    def subscribers(self, key: PollKey) -> List[Subscriber]:
+        with self.lock:
+            group = self.groups.get(key)
+            return [] if group is None else list(group.subscribers.keys())
+
+    def due(self, now: Optional[float] = None) -> List[PollKey]:
+        """Return the keys that must be fetched now and mark them as in flight until `done` is called."""
+        now = time.time() if now is None else now
+        dispatched = []
+        with self.lock:
+            for key, group in self.groups.items():
+                if group.in_flight or group.terminal or group.next_due > now:
+                    continue
+                dispatched.append((key, now - group.next_due))
+                group.in_flight = True
+                group.last_run = now
+                group.next_due = now + group.interval * group.backoff
+                self.dirty.add(key)
+        if self.on_dispatch is not None:
+            for key, lag in dispatched:
+                self.on_dispatch(key, lag)
+        return [key for key, _ in dispatched]
+
+    def done(self, key: PollKey, changed: Optional[bool] = None, state: Optional[str] = None):
+        """
+        Release a key fetched by `due`. `changed` and `state` (the shipment state of the result)
+        drive the adaptive interval, leave them as None when the poll gave no information.
+        """
+        with self.lock:
+            group = self.groups.get(key)
+            if group is None:
+                return
+            group.in_flight = False
+            if not self.adaptive or changed is None:
+                return
+            self.dirty.add(key)
+            if state == TERMINAL:
+                group.terminal = True
+            elif changed or state == DELIVERING:
+                group.backoff = 1
+            else:
+                group.backoff = min(group.backoff * 2, self.max_backoff)
+            group.next_due = group.last_run + group.interval * group.backoff
+
+    def stagger(self, saved: Mapping[PollKey, PollState], keys: Optional[List[PollKey]] = None,
+                spread: Optional[float] = None):
+        """
+        Spread the first polls after a restart instead of firing every key at once. Keys resume from
+        their saved next due time and backoff, and keys overdue or never saved are due at a random
+        point of the next `spread` seconds (their interval by default).
+        """
+        with self.lock:
+            self._stagger(saved, list(self.groups.keys()) if keys is None else keys, spread)
+
+    def _stagger(self, saved: Mapping[PollKey, PollState], keys: Iterable[PollKey], spread: Optional[float]):
+        now = time.time()
+        for key in keys:
+            group = self.groups.get(key)
+            if group is None:
+                continue
+            next_due, backoff = saved.get(key, (0.0, 1))
+            group.backoff = min(max(1, backoff), self.max_backoff) if self.adaptive else 1
+            interval = group.interval * group.backoff
+            if next_due > now:
+                # the delta may have been shortened since it was saved
+                group.next_due = min(next_due, now + interval)
+            else:
+                group.next_due = now + random.uniform(0, interval if spread is None else spread)
+
+    def changes(self) -> Dict[PollKey, PollState]:
+        """Pop the still polled keys whose schedule changed since the last call"""
+        with self.lock:
+            dirty, self.dirty = self.dirty, set()
+            return {key: (self.groups[key].next_due, self.groups[key].backoff)
+                    for key in dirty if key in self.groups}
@@ -0,0 +1,93 @@
+import hashlib
+import logging
+import time
+from typing import Iterable, List, Set
+
+from peewee import Expression, Field
+
+from models import ShardLease, WorkerModel, db
+from scheduler import PollKey
+
+logger = logging.getLogger(__name__)
+
+
+def _hash(value: str) -> int:
+    return int(hashlib.md5(value.encode()).hexdigest()[:16], 16)
+
+
+def key_hash(key: PollKey) -> int:
+    """Stable non-negative 31 bit hash of a key, stored with every job so shards can be selected in SQL"""
+    courier, cod = key
+    return _hash(f"{courier}\0{cod}") & 0x7fffffff
+
+
+def shard_of(key: PollKey, shards: int) -> int:
+    return key_hash(key) % shards
+
+
+def shard_sql(field: Field, shards: int) -> Expression:
+    """
+    `shard_of` in SQL for the rows whose `field` holds their key_hash. It uses integer division because
+    peewee turns % into LIKE and psycopg2 reads it as a placeholder.
+    """
+    return field - (field / shards) * shards
+
+
+def owner(shard: int, workers: Iterable[str]) -> str:
+    """Rendezvous hashing: only the shards of a dead or new worker move when the worker set changes"""
+    return max(workers, key=lambda worker: _hash(f"{shard}\0{worker}"))
+
+
+class ShardCoordinator:
+    """
+    Splits the (courier, cod) keys of all the poller processes in `shards` fixed shards through the
+    shared database. Every heartbeat a worker refreshes its WorkerModel row, computes which shards it
+    should own among the live workers, releases the others and takes or renews a ShardLease for its
+    own, so shards of a worker that stops heartbeating are taken over once its leases expire.
+    """
+
+    def __init__(self, worker_id: str, shards: int = 64, ttl: float = 30):
+        self.worker_id = worker_id
+        self.shards = shards
+        self.ttl = ttl
+        self.owned: Set[int] = set()
+
+    def alive(self, now: float) -> List[str]:
+        return [w.id for w in WorkerModel.select(WorkerModel.id).where(WorkerModel.heartbeat > now - self.ttl)]
+
+    def heartbeat(self) -> Set[int]:
+        """Renew the heartbeat and leases, returns the shards this worker may poll until the next one"""
+        now = time.time()
+        with db.atomic():
+            (WorkerModel.insert(id=self.worker_id, heartbeat=now)
+             .on_conflict(conflict_target=[WorkerModel.id], update={WorkerModel.heartbeat: now})
+             .execute())
+            workers = self.alive(now)
+            wanted = {shard for shard in range(self.shards) if owner(shard, workers) == self.worker_id}
+
+            (ShardLease.delete()
+             .where((ShardLease.worker_id == self.worker_id) & ShardLease.shard.not_in(list(wanted) or [-1]))
+             .execute())
+            for shard in wanted:
+                (ShardLease.insert(shard=shard, worker_id=self.worker_id, expires_at=now + self.ttl)
+                 .on_conflict(conflict_target=[ShardLease.shard],
+                              update={ShardLease.worker_id: self.worker_id, ShardLease.expires_at: now + self.ttl},
+                              where=((ShardLease.worker_id == self.worker_id) | (ShardLease.expires_at < now)))
+                 .execute())
+            owned = {lease.shard for lease in ShardLease.select(ShardLease.shard)
+                     .where((ShardLease.worker_id == self.worker_id) & (ShardLease.expires_at >= now))}
+
+        if owned != self.owned:
+            logger.info("Worker %s owns %d/%d shards (%d live workers)", self.worker_id, len(owned), self.shards,
+                        len(workers))
+        self.owned = owned
+        return owned
+
+    def owns(self, key: PollKey) -> bool:
+        return shard_of(key, self.shards) in self.owned
+
+    def release(self):
+        with db.atomic():
+            ShardLease.delete().where(ShardLease.worker_id == self.worker_id).execute()
+            WorkerModel.delete().where(WorkerModel.id == self.worker_id).execute()
+        self.owned = set()
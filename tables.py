@@ -1,12 +1,16 @@
+import hashlib
 import io
-from typing import List, Any
+import json
+import threading
+from collections import OrderedDict
+from typing import List, Any, Callable, Optional, Dict
 
-import matplotlib.pyplot as plt
-import plotly.figure_factory as ff
-import six
+# matplotlib, plotly and Pillow are imported inside each renderer, only the configured one is ever loaded
 
 
 def generate_image(table_raw: List[List[Any]], columns: List[str]) -> io.BytesIO:
+    import plotly.figure_factory as ff
+
     data_matrix = [columns, *table_raw]
     max_len = max([len(''.join(row)) for row in data_matrix])
 
@@ -26,6 +30,9 @@ FONT_SIZE = 14
 
 
 def old_generate_image(table_raw: List[List[Any]], columns: List[str]) -> io.BytesIO:
+    import matplotlib.pyplot as plt
+    import six
+
     row_colors = ['#f1f1f2', 'w']
     header_color = '#40466e'
 
@@ -67,5 +74,113 @@ def old_generate_image(table_raw: List[List[Any]], columns: List[str]) -> io.Byt
     fig.tight_layout()
     buf = io.BytesIO()
     fig.savefig(buf, format='png', dpi=DPI)
+    plt.close(fig)
+    buf.seek(0)
+    return buf
+
+
+def pillow_generate_image(table_raw: List[List[Any]], columns: List[str]) -> io.BytesIO:
+    from PIL import Image, ImageDraw, ImageFont
+
+    row_colors = ['#f1f1f2', '#ffffff']
+    header_color = '#40466e'
+    padding = FONT_SIZE // 2
+
+    try:
+        font = ImageFont.truetype("DejaVuSans.ttf", 2 * FONT_SIZE)
+    except OSError:
+        font = ImageFont.load_default()
+
+    if len(table_raw) == 0:
+        cell_text = [['-'] * len(columns)]
+    else:
+        cell_text = [[str(item) for item in row] for row in table_raw]
+    rows = [columns, *cell_text]
+
+    widths = [max(font.getbbox(row[i])[2] for row in rows) + 2 * padding for i in range(len(columns))]
+    height = font.getbbox("Ag")[3] + 2 * padding
+
+    image = Image.new('RGB', (sum(widths), height * len(rows)), 'white')
+    draw = ImageDraw.Draw(image)
+    for r, row in enumerate(rows):
+        top = r * height
+        draw.rectangle([0, top, image.width, top + height], fill=header_color if r == 0 else row_colors[r % 2])
+        left = 0
+        for text, width in zip(row, widths):
+            draw.text((left + padding, top + padding), text, font=font, fill='white' if r == 0 else 'black')
+            left += width
+
+    buf = io.BytesIO()
+    image.save(buf, format='png', optimize=True)
     buf.seek(0)
     return buf
+
+
+def text_table(table_raw: List[List[Any]], columns: List[str]) -> str:
+    """Monospace table to send as a markdown code block"""
+    from tabulate import tabulate
+
+    cell_text = [[str(item).replace('`', "'") for item in row] for row in table_raw]
+    return tabulate(cell_text or [['-'] * len(columns)], headers=columns, tablefmt='simple')
+
+
+renderers: Dict[str, Callable[[List[List[Any]], List[str]], io.BytesIO]] = {
+    'matplotlib': old_generate_image,
+    'plotly': generate_image,
+    'pillow': pillow_generate_image,
+}
+
+
+class ImageCache:
+    """
+    LRU of rendered table PNGs bounded by total bytes, keyed by a hash of the table content, plus the
+    telegram file_id of every image already uploaded so an identical table is re-sent without uploading.
+    """
+
+    def __init__(self, max_bytes: int = 32 * 1024 * 1024, max_file_ids: int = 4096):
+        self.max_bytes = max_bytes
+        self.max_file_ids = max_file_ids
+        self.images: 'OrderedDict[str, bytes]' = OrderedDict()
+        self.file_ids: 'OrderedDict[str, str]' = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def key(table_raw: List[List[Any]], columns: List[str]) -> str:
+        return hashlib.sha1(json.dumps([columns, table_raw], default=str).encode()).hexdigest()
+
+    def get_file_id(self, key: str) -> Optional[str]:
+        with self.lock:
+            file_id = self.file_ids.get(key)
+            if file_id is not None:
+                self.file_ids.move_to_end(key)
+            return file_id
+
+    def set_file_id(self, key: str, file_id: Optional[str]):
+        with self.lock:
+            if file_id is None:
+                self.file_ids.pop(key, None)
+                return
+            self.file_ids[key] = file_id
+            self.file_ids.move_to_end(key)
+            while len(self.file_ids) > self.max_file_ids:
+                self.file_ids.popitem(last=False)
+
+    def render(self, key: str, table_raw: List[List[Any]], columns: List[str],
+               renderer: Callable[[List[List[Any]], List[str]], io.BytesIO] = old_generate_image) -> io.BytesIO:
+        with self.lock:
+            image = self.images.get(key)
+            if image is not None:
+                self.images.move_to_end(key)
+                return io.BytesIO(image)
+
+        image = renderer(table_raw, columns).getvalue()
+
+        with self.lock:
+            if key not in self.images and len(image) <= self.max_bytes:
+                self.images[key] = image
+                self.size += len(image)
+                while self.size > self.max_bytes:
+                    _, evicted = self.images.popitem(last=False)
+                    self.size -= len(evicted)
+        return io.BytesIO(image)